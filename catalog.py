@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+
+description = """
+Indexed SQLite catalog of the subtitle metadata (subtitle table, export file,
+OMDb dump and ratings), built once from the flat files such that each
+partition job only queries the rows for its language and subtitles instead
+of scanning the flat files in full. Also builds the sidecar indices of the
+source archives, mapping each file identifier to the offset and size of its
+member in the tar file.
+
+"""
+
+import os, sys, json, sqlite3, tarfile
+
+catalogVersion = 1
+indexVersion = 1
+
+# Tables of the catalog, with their columns. The rows are stored in the order
+# of the flat files (the rowid), which is also the order in which they are
+# returned by the queries.
+tables = {"subtitles":["langcode", "subid", "imdb", "format", "numcds", "date",
+                       "year", "fps"],
+          "files":["subid", "fileid", "cdnum"],
+          "sources":["imdb", "year", "duration", "genre", "original", "country"],
+          "ratings":["subid", "nbbad", "avgscore", "nbvotes", "member"]}
+
+# Columns on which the tables are indexed
+indices = {"subtitles":"langcode", "files":"subid", "sources":"imdb",
+           "ratings":"subid"}
+
+
+# Readers of the flat files, yielding the rows of each table
+def readInfoFile(infoFile):
+    """Yields the rows of the subtitle table (with one line per subtitle)."""
+    with open(infoFile, 'r') as fd:
+        fd.readline()
+        for line in fd:
+            split = line.split('\t')
+            if len(split) == 16:
+                yield (split[4], split[0], split[6], split[7], int(split[8]),
+                       split[5].split(" ")[0], split[2], split[10])
+
+
+def readExportFile(exportFile):
+    """Yields the (subid, fileid, cdnum) rows of the export file."""
+    with open(exportFile, 'r') as fd:
+        for l in fd:
+            split = l.rstrip().split('\t')
+            if len(split)>=6 and split[1] and split[4]:
+                yield (split[3], split[1], int(split[4]))
+
+
+def readOmdbFile(omdbFile):
+    """Yields the rows of the OMDb dump (with one line per movie)."""
+    with open(omdbFile, 'r', encoding="latin-1") as fd:
+        fd.readline()
+        for line in fd:
+            split = line.split('\t')
+            if len(split) > 18:
+                yield (split[0], split[3], split[5], split[6], split[17], split[18])
+
+
+def readRatingFile(ratingFile):
+    """Yields the rows of the ratings file (with one line per subtitle)."""
+    with open(ratingFile, 'r') as fd:
+        for line in fd:
+            split = line.split(',')
+            if len(split) >= 5:
+                yield tuple(s.strip("\"") for s in split[:5])
+
+
+def getSourceInfo(sourceFiles):
+    """Returns the modification time and size of the flat files."""
+    info = {}
+    for path in sourceFiles:
+        stat = os.stat(path)
+        info[path] = {"mtime":stat.st_mtime, "size":stat.st_size}
+    return info
+
+
+def buildCatalog(catalogFile, infoFile, exportFile, omdbFile, ratingFile):
+    """Builds the catalog from the flat files. For the subtitle table, later
+    lines for the same language and subtitle identifier update the row but
+    keep its position (as in a Python dictionary), such that the partitions
+    are identical to those computed on the flat files.
+
+    """
+    sys.stderr.write("Building catalog %s\n"%catalogFile)
+    if os.path.exists(catalogFile):
+        os.remove(catalogFile)
+    db = sqlite3.connect(catalogFile)
+    for table, columns in tables.items():
+        db.execute("CREATE TABLE %s (%s)"%(table, ", ".join(columns)))
+    db.execute("CREATE UNIQUE INDEX subtitles_key ON subtitles (langcode, subid)")
+    db.execute("CREATE TABLE meta (key PRIMARY KEY, value)")
+
+    columns = tables["subtitles"]
+    updates = ", ".join("%s=excluded.%s"%(c,c) for c in columns[2:])
+    db.executemany("INSERT INTO subtitles VALUES (%s) ON CONFLICT (langcode, subid) DO UPDATE SET %s"
+                   %(", ".join("?"*len(columns)), updates), readInfoFile(infoFile))
+    for table, reader, path in [("files", readExportFile, exportFile),
+                                ("sources", readOmdbFile, omdbFile),
+                                ("ratings", readRatingFile, ratingFile)]:
+        db.executemany("INSERT INTO %s VALUES (%s)"%(table, ", ".join("?"*len(tables[table]))),
+                       reader(path))
+    for table, column in indices.items():
+        if table != "subtitles":
+            db.execute("CREATE INDEX %s_%s ON %s (%s)"%(table, column, table, column))
+
+    sources = [infoFile, exportFile, omdbFile, ratingFile]
+    db.executemany("INSERT INTO meta VALUES (?, ?)",
+                   [("version", json.dumps(catalogVersion)),
+                    ("sources", json.dumps(getSourceInfo(sources)))])
+    db.commit()
+    for table in tables:
+        nbRows = db.execute("SELECT COUNT(*) FROM %s"%table).fetchone()[0]
+        sys.stderr.write("Number of rows in %s: %i\n"%(table, nbRows))
+    db.close()
+
+
+class Catalog:
+    """Read-only access to a catalog built with buildCatalog."""
+
+    def __init__(self, catalogFile):
+        self.catalogFile = catalogFile
+        self.db = sqlite3.connect(catalogFile)
+
+
+    def getMeta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+
+    def isUpToDate(self, sourceFiles):
+        """Returns true if the catalog was built (with the current version)
+        from the flat files in their current state.
+
+        """
+        if self.getMeta("version") != catalogVersion:
+            return False
+        sources = self.getMeta("sources")
+        try:
+            return sources == getSourceInfo(sourceFiles)
+        except OSError:
+            return False
+
+
+    def getSubtitles(self, langcode):
+        """Returns the rows of the subtitle table for the language."""
+        return self.db.execute("SELECT %s FROM subtitles WHERE langcode=? ORDER BY rowid"
+                               %", ".join(tables["subtitles"]), (langcode,)).fetchall()
+
+
+    def getRows(self, table, keys):
+        """Returns the rows of the table whose indexed column has one of the
+        given values (in the order of the flat file).
+
+        """
+        self.db.execute("CREATE TEMP TABLE IF NOT EXISTS selection (key PRIMARY KEY)")
+        self.db.execute("DELETE FROM selection")
+        self.db.executemany("INSERT OR IGNORE INTO selection VALUES (?)",
+                            [(k,) for k in keys])
+        rows = self.db.execute("SELECT %s FROM %s WHERE %s IN (SELECT key FROM selection) "
+                               %(", ".join(tables[table]), table, indices[table])
+                               + "ORDER BY rowid").fetchall()
+        self.db.execute("DELETE FROM selection")
+        return rows
+
+
+    def close(self):
+        self.db.close()
+
+
+def openCatalog(catalogFile, sourceFiles):
+    """Opens the catalog if it exists and is up to date with the flat files,
+    and returns None otherwise (in which case the flat files should be read).
+
+    """
+    if not catalogFile or not os.path.exists(catalogFile):
+        if catalogFile:
+            sys.stderr.write("Catalog %s not found, reading the flat files\n"%catalogFile)
+        return None
+    catalog = Catalog(catalogFile)
+    if not catalog.isUpToDate(sourceFiles):
+        sys.stderr.write("Catalog %s is out of date, reading the flat files "%catalogFile
+                         + "(rebuild it with catalog.py)\n")
+        catalog.close()
+        return None
+    return catalog
+
+
+def getArchiveIndexPath(archiveFile):
+    """Returns the path of the sidecar index for the archive."""
+    return archiveFile + ".idx"
+
+
+def buildArchiveIndex(archiveFile):
+    """Scans the headers of the tar archive and writes its sidecar index, 
+    which is a tab-separated file with a header line:
+    
+        #archive-index  <version>  <archive size>  <archive mtime (ns)>
+    
+    followed by one line per regular member, in archive order:
+    
+        <file identifier>  <offset of the data>  <size>  <member name>
+        
+    The index is written to a temporary file and then moved into place, such
+    that concurrent jobs never read a partial index. Returns the entries.
+    
+    """
+    sys.stderr.write("Building the member index of %s\n"%archiveFile)
+    stat = os.stat(archiveFile)
+    entries = []
+    with tarfile.open(archiveFile, mode='r') as fdtar:
+        for member in fdtar:
+            if member.isreg():
+                fileId = os.path.basename(member.name).split(".")[0]
+                entries.append((fileId, member.offset_data, member.size, member.name))
+    
+    indexFile = getArchiveIndexPath(archiveFile)
+    tmpFile = "%s.%i.tmp"%(indexFile, os.getpid())
+    try:
+        with open(tmpFile, 'w', encoding="utf-8") as fd:
+            fd.write("#archive-index\t%i\t%i\t%i\n"%(indexVersion, stat.st_size, 
+                                                     stat.st_mtime_ns))
+            for entry in entries:
+                fd.write("%s\t%i\t%i\t%s\n"%entry)
+        os.replace(tmpFile, indexFile)
+    except OSError as e:
+        sys.stderr.write("Cannot write the member index %s: %s\n"%(indexFile, e))
+        if os.path.exists(tmpFile):
+            os.remove(tmpFile)
+    return entries
+
+
+def readArchiveIndex(archiveFile):
+    """Returns the entries of the sidecar index of the archive, or None if 
+    the index does not exist or does not match the current size and 
+    modification time of the archive.
+    
+    """
+    indexFile = getArchiveIndexPath(archiveFile)
+    if not os.path.exists(indexFile):
+        return None
+    stat = os.stat(archiveFile)
+    with open(indexFile, 'r', encoding="utf-8") as fd:
+        header = fd.readline().rstrip("\n").split("\t")
+        if header != ["#archive-index", str(indexVersion), str(stat.st_size), 
+                      str(stat.st_mtime_ns)]:
+            sys.stderr.write("Member index %s is out of date\n"%indexFile)
+            return None
+        entries = []
+        for line in fd:
+            fileId, offset, size, name = line.rstrip("\n").split("\t", 3)
+            entries.append((fileId, int(offset), int(size), name))
+    return entries
+
+
+def getArchiveIndex(archiveFile):
+    """Returns the (offset, size) pairs of the archive members indexed by
+    file identifier, from the sidecar index (which is built if it is missing
+    or out of date). For repeated identifiers, the last member is kept.
+    
+    """
+    entries = readArchiveIndex(archiveFile)
+    if entries is None:
+        entries = buildArchiveIndex(archiveFile)
+    return {fileId:(offset, size) for fileId, offset, size, _ in entries}
+
+
+if __name__ == '__main__':
+
+    import argparse
+    import tar2xml
+
+    cmdOptions = argparse.ArgumentParser(prog="catalog", description=description)
+    cmdOptions.add_argument("catalogFile", nargs="?", default=tar2xml.catalogFile,
+                            help="Path to the catalog (default is %s)"%tar2xml.catalogFile)
+    cmdOptions.add_argument("--info", dest="infoFile", default=tar2xml.infoFile,
+                            help="Path to the subtitle table")
+    cmdOptions.add_argument("--export", dest="exportFile", default=tar2xml.exportFile,
+                            help="Path to the export file")
+    cmdOptions.add_argument("--omdb", dest="omdbFile", default=tar2xml.omdbFile,
+                            help="Path to the OMDb dump")
+    cmdOptions.add_argument("--ratings", dest="ratingFile", default=tar2xml.ratingFile,
+                            help="Path to the ratings file")
+    cmdOptions.add_argument("--index", dest="archiveFiles", nargs="+",
+                            help="""Source archives whose member index should be
+                            built (instead of the catalog)""")
+    args = vars(cmdOptions.parse_args())
+
+    archiveFiles = args.pop("archiveFiles")
+    if archiveFiles:
+        for archiveFile in archiveFiles:
+            buildArchiveIndex(archiveFile)
+    else:
+        buildCatalog(**args)
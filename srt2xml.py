@@ -6,10 +6,10 @@ simple tokenization and sentence splitting procedure.
 
 """
 
-import sys, os, io,json,re,time
-import xml.etree.cElementTree as et
+import sys, os, io,json,re,time,codecs,bisect
 import utils
 from utils import Tokeniser,SpellChecker
+from writers import writers, formatTime
     
 # Regex to detect the subtitle indices at the start of each block    
 numberRegex = re.compile("(\d+)\r*\n")
@@ -35,18 +35,31 @@ stopPunctuations2 = ['.', ':', ';','。','；','：','|']
 quotationRegex = re.compile("``|''|´´|[“„”«»]")
 quotationRegex2 = re.compile("[‘’›‹]")
 
+# Regex to detect (in one pass) the quotation markers, ellipses and multiple
+# occurrences of punctuation marks, with their replacements
+cleaningRegex = re.compile(r"``|''|´´|[“„”«»‘’›‹…‥]|([\?!:,;]|\s)\1+")
+cleaningTable = {"``":'"', "''":'"', "´´":'"', "“":'"', "„":'"', "”":'"', "«":'"', 
+                 "»":'"', "‘":"'", "’":"'", "›":"'", "‹":"'", "…":"...", "‥":"..."}
+
 # Languages for which multiple alternative encodings are possible
 difficult_langs = ["zh", 'zt','ja','ko','bg','el','he','th','ru','sr']
 
 PAUSE_THR1 = 1       # > 1 second --> most probably new sentence
 PAUSE_THR2 = 3       # > 3 second --> definitely new sentence
 WORDS_THR = 40       # Higher bound on number of words in sentence
+BLOCK_BATCH = 250    # Number of subtitle blocks tokenised in one exchange
+ENCODING_SAMPLE = 65536   # Maximum number of bytes inspected to detect the encoding
+STREAM_CHUNK = 65536      # Number of bytes decoded at once in streaming mode
+STREAM_MAX_LINE = 1048576 # Maximum length of a line buffered in streaming mode
+STREAM_TEXT = 100000      # Characters kept for language identification in streaming mode
+STREAM_VALIDATE = 1048576 # Number of bytes validated to select the encoding in streaming mode
 
     
 class SubtitleConverter:
 
     def __init__(self, input, output, rawOutput=None, language=None, 
-                meta=None, encoding=None, alwaysSplit=False):
+                meta=None, encoding=None, alwaysSplit=False, tokeniser=None,
+                spellchecker=None, outputFormat="xml", stream=False):
         """Creates a new converter for a given input and output (as file
         objects). A second file object for the raw output can also be provided.
         
@@ -59,6 +72,13 @@ class SubtitleConverter:
             encoding(str): file encoding to use to read the raw subtitle files
             alwaysSplit(bool): whether to always split subtitle blocks as new 
                 sentences (default is false).
+            tokeniser(Tokeniser object): tokeniser owned by the caller and 
+                reused across conversions (if None, a new one is started)
+            spellchecker(SpellChecker object): spellchecker owned by the caller
+                and reused across conversions (if None, a new one is created)
+            outputFormat(str): format of the outputs (see writers.writers)
+            stream(bool): whether to decode the raw subtitle files chunk by 
+                chunk (with bounded memory) instead of in full
         """
                     
         self.lang = language
@@ -67,16 +87,22 @@ class SubtitleConverter:
             self.alwaysSplit = True
             
         self.inputs = input if isinstance(input,list) else [input]
+        self.stream = stream
         
         self.encodings = [encoding] if encoding else []
         self.encodings += (self.lang.encodings if self.lang else [])
+        self.detection = None
         if not self.lang or self.lang.codes[0] in difficult_langs:
-            detected = detectEncoding(self.inputs[0], self.encodings)
-            self.encodings = [detected] + self.encodings
+            self.detection = detectEncoding(self.inputs[0], self.encodings)
+            self.encodings = [self.detection[0]] + self.encodings
                         
         self.output = output
         self.rawOutput = rawOutput   
+        self.writer = writers[outputFormat](output)
+        self.rawWriter = writers[outputFormat](rawOutput, True) if rawOutput else None
         self.meta = meta    
+        self.sharedTokeniser = tokeniser
+        self.sharedSpellchecker = spellchecker
         
     
     def doConversion(self):   
@@ -87,52 +113,84 @@ class SubtitleConverter:
         self.curLine = None                     # Current line in the raw file
         self.curBlock = None                    # Current block
         self.curLineIndex = 0                   # Current line index in the raw file
-        self.timeOffset = 0                     # Time offset (for multi-CD subtitles)
+        self.curText = None                     # Decoded content of the raw file
+        self.curPos = 0                         # Current position in the content
+        self.curDecoder = None                  # Incremental decoder (streaming mode)
+        self.timeOffset = 0                     # Time offset in ms (for multi-CD subtitles)
+        self.endOfInput = False                 # Whether all blocks have been read
 
         self.sid = 0                            # Current sentence identifier
         self.nbTokens = 0                       # Total number of words
         self.nbIgnoredBlocks = 0                # Number of ignored subtitle blocks
+        self.nbFastTimings = 0                  # Timings parsed in canonical layout
+        self.nbSlowTimings = 0                  # Timings parsed with the regex
         self.sentence = Sentence()     # Tokens in the current sentence
         self.text = ""                          # Collection of all subtitle lines
         
-        # Starting the tokeniser and spellchecker
-        self.tokeniser = Tokeniser(self.lang)
-        self.spellchecker = SpellChecker(self.lang)
+        # Starting the tokeniser and spellchecker (unless provided by the caller)
+        self.tokeniser = self.sharedTokeniser or Tokeniser(self.lang)
+        self.spellchecker = self.sharedSpellchecker or SpellChecker(self.lang)
+        self.spellchecker.resetCounters()
+        self.cacheCounts = (self.tokeniser.cache.hits, self.tokeniser.cache.misses)
         
         self._startDocument()       
     
-        # Looping on the subtitle blocks
-        block = self._readBlock()
-        while block:              
-            # Ignoring spurious subtitle blocks    
-            if block.isSpurious():
-                self.nbIgnoredBlocks += 1
-                block = self._readBlock()
-                continue
-            
-            self._writeBlock(block)           
-            block = self._readBlock()
+        # Looping on the subtitle blocks (read and tokenised in batches)
+        blocks = self._readBlocks()
+        while blocks:              
+            for block in blocks:
+                self._writeBlock(block)           
+            blocks = self._readBlocks()
             
         self._flushDocument()
-        self.tokeniser.close()
+        if not self.sharedTokeniser:
+            self.tokeniser.close()
         
        
     def _startDocument(self):
-        """Writes the header of the XML subtitle file. 
+        """Writes the header of the output file(s). 
         
         """
         id = self.meta["id"] if self.meta and "id" in self.meta else ""
         if not id and self.inputs and  hasattr(self.inputs[0],"name"):
             id = os.path.basename(self.inputs[0].name).split(".")[0]
-        id = id.encode("utf-8")
             
-        self.output.write(b'<?xml version="1.0" encoding="utf-8"?>\n')
-        self.output.write(b'<document id="' + id + b'">\n')
-        if self.rawOutput:
-            self.rawOutput.write(b'<?xml version="1.0" encoding="utf-8"?>\n')
-            self.rawOutput.write(b'<document id="' + id + b'">\n') 
+        self.writer.startDocument(id)
+        if self.rawWriter:
+            self.rawWriter.startDocument(id)
               
    
+    def _readBlocks(self):
+        """Reads the next batch of subtitle blocks (ignoring the spurious 
+        ones), and tokenises their lines in one single exchange with the
+        tokeniser.  Returns an empty list at the end of the input.
+        
+        """
+        blocks = []
+        while not self.endOfInput and len(blocks) < BLOCK_BATCH:
+            block = self._readBlock()
+            if not block:
+                self.endOfInput = True
+            elif block.isSpurious():
+                self.nbIgnoredBlocks += 1
+            else:
+                blocks.append(block)
+        self._tokeniseBlocks(blocks)
+        return blocks
+        
+        
+    def _tokeniseBlocks(self, blocks):
+        """Tokenises all lines of the blocks at once, and attaches the list of 
+        tokens for each line to the blocks.
+        
+        """
+        tokenised = self.tokeniser.tokeniseLines([l for b in blocks for l in b.lines])
+        start = 0
+        for block in blocks:
+            block.tokens = tokenised[start:start+len(block.lines)]
+            start += len(block.lines)
+    
+    
     def _readBlock(self, recursive=0):
         """Reads one subtitle block and returns it.
           
@@ -157,23 +215,26 @@ class SubtitleConverter:
         if not self.curLine:
             self.inputs.pop(0)
             self.curLineIndex = 0
+            self.curText = None
+            self.curPos = 0
+            self.curDecoder = None
             
             if self.inputs:
                 nextBlock = self._readBlock()
-                lasttime = tosecs(block.previous.end) if block.previous else 0
+                lasttime = block.previous.end if block.previous else 0
                 # shifting the start and end times after the first CD
-                if nextBlock and nextBlock.start and lasttime > tosecs(nextBlock.start):
-                    nextBlock.start = addsecs(nextBlock.start, lasttime-self.timeOffset)
-                    nextBlock.end = addsecs(nextBlock.end, lasttime-self.timeOffset)
+                if (nextBlock and nextBlock.start is not None 
+                    and lasttime > nextBlock.start):
+                    nextBlock.shiftTiming(lasttime-self.timeOffset)
                     self.timeOffset = lasttime
                 return nextBlock
             else:
                 return None
                   
         # Detects the subtitle identifier
-        numberMatch = numberRegex.match(self.curLine)
-        if numberMatch:
-            block.setId(int(numberMatch.group(1)))
+        number = parseNumber(self.curLine)
+        if number is not None:
+            block.setId(number)
             self._readline()
         else:        
             block.setId((self.curBlock.id+1) if self.curBlock else 1)
@@ -183,14 +244,14 @@ class SubtitleConverter:
             self._readline() 
             
         # Detects the start and end time           
-        timingMatch = timingRegex.match(self.curLine)
-        if not timingMatch:
+        timing = self._parseTiming(self.curLine)
+        if not timing:
             sys.stderr.write("Cannot parse timing (line number: %i): %s"
                              %(self.curLineIndex, self.curLine))
             self._readline()
             self.nbIgnoredBlocks += 1
             return self._readBlock(recursive+1)
-        block.setTiming(timingMatch.group(1), timingMatch.group(2)) 
+        block.setTiming(*timing) 
    
         # Reads the subtitle content until we arrive at the next subtitle ID
         # or the end of the file (NB: simply stopping at an empty line does
@@ -200,7 +261,7 @@ class SubtitleConverter:
         while self.curLine.strip():
             block.addLine(self.curLine)
             self._readline()          
-        while self.curLine and not numberRegex.match(self.curLine):
+        while self.curLine and parseNumber(self.curLine) is None:
             block.addLine(self.curLine)
             self._readline()
 
@@ -208,31 +269,126 @@ class SubtitleConverter:
         return block
     
     
+    def _parseTiming(self, line):
+        """ Returns the start and end times (in milliseconds) in the timing 
+        line followed by the start and end time strings, or None if the line
+        cannot be parsed. The canonical layout is parsed directly, and the 
+        other ones with the (slower) timing regex. 
+        
+        """
+        timing = parseCanonicalTiming(line)
+        if timing:
+            self.nbFastTimings += 1
+            line = line.strip()
+            return timing + (line[:12], line[17:])
+        timingMatch = timingRegex.match(line)
+        if timingMatch:
+            self.nbSlowTimings += 1
+            start, end = timingMatch.group(1), timingMatch.group(2)
+            return tomillis(start), tomillis(end), start, end
+        return None
+    
+    
     def _readline(self):
-        """ Reads the next line in the file, decodes it according to the
-        current encoding, and returns it. If a decoding error is detected,
-        tries to change the encoding if an alternative is possible.
+        """ Reads the next line in the decoded content of the current file 
+        (which is decoded in full when its first line is read, or chunk by 
+        chunk in streaming mode).
+        
+        """
+        if self.curText is None:
+            if not self.inputs:
+                self.curLine = ""
+                return
+            if self.stream:
+                self.curDecoder, self.curText = self._openStream(self.inputs[0])
+            else:
+                self.curText = self._decodeInput(self.inputs[0])
+            self.curPos = 0
+            
+        text, pos = self.curText, self.curPos
+        end = text.find("\n", pos)
+        while end < 0 and self.curDecoder and len(text) - pos < STREAM_MAX_LINE:
+            text, pos = self._decodeChunk(text[pos:]), 0
+            self.curText = text
+            end = text.find("\n")
+        if end >= 0:
+            end += 1
+        else:
+            end = min(len(text), pos + STREAM_MAX_LINE) if self.stream else len(text)
+        self.curLine = text[pos:end]
+        self.curPos = end
+        self.curLineIndex += 1
+        
+        
+    def _decodeInput(self, input):
+        """ Reads the full content of the file object and decodes it according 
+        to the current encoding. If a decoding error is detected, removes the
+        encoding from the list of possible encodings and decodes the whole 
+        content again with the next one.
         
         """
-        if self.inputs:
-            binaryLine = self.inputs[0].readline()
-        self.curLine = None
-        while self.curLine==None and self.encodings:
+        binaryText = input.read()
+        while self.encodings:
             encoding = self.encodings[0]  
             try:
-                self.curLine = binaryLine.decode(encoding)
-            except UnicodeDecodeError:
-                # If we get a decoding error, removes the encoding from
-                # the list of possible encodings, and retry.
+                return binaryText.decode(encoding).lstrip("\ufeff")
+            except UnicodeDecodeError as e:
+                sys.stderr.write("Cannot decode file with %s (position: %i)\n"
+                                 %(encoding, e.start))
                 self.encodings.remove(encoding)
-
-        if self.curLine==None:
-            raise RuntimeError("Decoding error (encoding: %s, line: %i)"
-                             %(encoding, self.curLineIndex))
-        elif self.curLineIndex==0:
-            self.curLine = self.curLine.lstrip("\ufeff")
-
-        self.curLineIndex += 1
+        raise RuntimeError("Decoding error (no valid encoding for file)")
+    
+    
+    def _openStream(self, input):
+        """ Selects the encoding for the file object by decoding the start of
+        its content (up to STREAM_VALIDATE bytes, removing the encodings that 
+        fail, as in _decodeInput). Returns the incremental decoder for the rest
+        of the content (or None if the file was decoded in full) along with 
+        the decoded text. 
+        
+        """
+        prefix = b""
+        chunk = input.read(STREAM_CHUNK)
+        while chunk:
+            prefix += chunk
+            if len(prefix) >= STREAM_VALIDATE:
+                break
+            chunk = input.read(STREAM_CHUNK)
+            
+        while self.encodings:
+            encoding = self.encodings[0]
+            decoder = codecs.getincrementaldecoder(encoding)()
+            try:
+                text = decoder.decode(prefix, final=not chunk).lstrip("\ufeff")
+                return (decoder if chunk else None), text
+            except UnicodeDecodeError as e:
+                sys.stderr.write("Cannot decode file with %s (position: %i)\n"
+                                 %(encoding, e.start))
+                self.encodings.remove(encoding)
+        raise RuntimeError("Decoding error (no valid encoding for file)")
+    
+    
+    def _decodeChunk(self, text):
+        """ Decodes the next chunk of the current file object in streaming
+        mode and appends it to the (not yet consumed) text. As the previous
+        lines are already processed, a decoding error after the validated 
+        start of the file makes the conversion of the file fail.
+        
+        """
+        input = self.inputs[0]
+        chunk = input.read(STREAM_CHUNK)
+        try:
+            text += self.curDecoder.decode(chunk, final=not chunk)
+        except UnicodeDecodeError as e:
+            encoding = self.encodings[0]
+            sys.stderr.write("Cannot decode file with %s (position: %i)\n"
+                             %(encoding, input.tell() - len(chunk) + e.start))
+            self.encodings.remove(encoding)
+            raise RuntimeError("Decoding error (invalid %s after %i bytes)"
+                               %(encoding, STREAM_VALIDATE))
+        if not chunk:
+            self.curDecoder = None
+        return text
   
                       
     def _writeBlock(self, block):
@@ -245,14 +401,14 @@ class SubtitleConverter:
         if not self._isContinuation(block):    
             self._flushSentence()
          
-        self.sentence.addStamp("T%sS"%block.id, block.start)
+        self.sentence.addStamp("T%sS"%block.id, block.start, block.startStr)
         
         # Loops on each line of the subtitle block
         for linenum in range(0,len(block.lines)):
-            self.sentence.addRawChar(' ' if self.sentence.raw else '')
+            self.sentence.addRawChar(' ' if self.sentence.rawParts else '')
             self._recordLine(block, linenum)       
             
-        self.sentence.addStamp("T%sE"%block.id, block.end)
+        self.sentence.addStamp("T%sE"%block.id, block.end, block.endStr)
     
         
   
@@ -262,9 +418,12 @@ class SubtitleConverter:
         sentence in that case.
         
         """
-        # Doing the actual tokenisation
+        # Doing the actual tokenisation (unless already done for the block)
         line = block.lines[linenum]
-        tokens = self.tokeniser.tokenise(line)   
+        if block.tokens:
+            tokens = block.tokens[linenum]
+        else:
+            tokens = self.tokeniser.tokenise(line)   
         curPos = 0       # Current character position in the line
 
         upperline = len([c for c in line if c.isupper() or not c.isalpha()]) > 2*len(line)/3
@@ -357,10 +516,10 @@ class SubtitleConverter:
             score += 1
 
         # Scoring based on time gaps
-        if block.start and block.previous.end:
-            pause = tosecs(block.start) - tosecs(block.previous.end)
-            score += (-1 if pause > PAUSE_THR1 else 0)
-            score += (-1 if pause > PAUSE_THR2 else 0)
+        if block.start is not None and block.previous.end is not None:
+            pause = block.start - block.previous.end
+            score += (-1 if pause > PAUSE_THR1*1000 else 0)
+            score += (-1 if pause > PAUSE_THR2*1000 else 0)
             
         # Scoring based on sentence lengths
         score += (-1 if self.sentence.getNbStamps() >3 else 0)
@@ -370,7 +529,7 @@ class SubtitleConverter:
 
 
     def _flushSentence(self):
-        """ Writes the tokens to the XML file (and the untokenised output if
+        """ Writes the tokens to the output file (and the untokenised output if
         that option is activated) and clears the current sentence.
         
         """ 
@@ -380,12 +539,14 @@ class SubtitleConverter:
         self.nbTokens += nbTokens 
         self.sid += 1
         self._pruneTokens()           
-        self._writeTokens()
-        if self.rawOutput:
-            self._writeRaw()
+        self.writer.writeSentence(self.sid, self.sentence)
+        if self.rawWriter:
+            self.rawWriter.writeSentence(self.sid, self.sentence)
         
         # We record the text content for language identification purposes
-        self.text += self.sentence.rawCorrected + "\n"
+        # (in streaming mode, only the start of the subtitle is recorded)
+        if not self.stream or len(self.text) < STREAM_TEXT:
+            self.text += self.sentence.rawCorrected + "\n"
         
         self.sentence = Sentence() 
         
@@ -397,86 +558,13 @@ class SubtitleConverter:
             if (entities[i][0]=="w"  and (entities[i][1]=="..." or entities[i][1]=="-") 
                 and entities[i+1][0]=="time" and entities[i+2][0]=="time" 
                 and entities[i+3][0]=="w" and entities[i+3][1]==entities[i][1]):
-                self.sentence.entities = entities[0:i] +entities[i+1:i+3] + entities[i+4:]
+                self.sentence.removeEntity(i+3)
+                self.sentence.removeEntity(i)
                 self.sentence.raw = self.sentence.raw.replace("... ...", " ")
                 self.sentence.raw = self.sentence.raw.replace("- -", " ")
                 break
         
           
-    def _writeTokens(self):
-        """ Writes the tokens in self.sentence to the XML file. 
-                
-        """
-        builder = et.TreeBuilder()  
-        sattrs = {"id":str(self.sid)}
-        if self.sentence.isEmphasised():
-            sattrs.update({"emphasis":"true"})
-            for w in self.sentence.getTokens():
-                del w[2]["emphasis"]
-        builder.start("s",sattrs)
-        tokid = 0
-        entities= self.sentence.getEntities()
-        for i, entity in enumerate(entities):
-            
-            if entity[0]=="w":
-                token = entity[1]
-                tokid += 1
-              
-                builder.data("\n    ")
-                wattrs = {"id":"%i.%i"%(self.sid,tokid)}
-                wattrs.update(entity[2])
-                builder.start("w",wattrs)
-                builder.data(token)
-                builder.end("w") 
-                     
-            # Write a <time> entity
-            elif entity[0]=="time":
-                builder.data("\n    ")
-                builder.start("time",entity[1])
-                builder.end("time")    
-          
-        builder.data("\n  ")
-        builder.end("s")
-        tree = et.ElementTree(builder.close())
-        self.output.write(b"  ")
-        tree.write(self.output, encoding='utf-8')
-        self.output.write(b"\n") 
-        
-        
-               
-    def _writeRaw(self):
-        """ Writes the raw sentence to the XML file. 
-                
-        """
-        builder = et.TreeBuilder()  
-        attrs =  {"id":str(self.sid)}
-        builder.start("s",attrs)
-
-        # Add timing info at the beginning of the sentence
-        entities = self.sentence.getEntities()
-        if entities and entities[0][0] == "time":
-            builder.data("\n    ")
-            builder.start("time",entities[0][1])
-            builder.end("time")  
-            
-        builder.data("\n")
-        builder.data(self.sentence.raw)
-          
-        # Add timing info at the end of the sentence
-        if entities and entities[-1][0] == "time":
-            builder.data("\n    ")
-            builder.start("time",entities[-1][1])
-            builder.end("time")   
-          
-        builder.data("\n  ")
-        builder.end("s")
-        tree = et.ElementTree(builder.close())
-        self.rawOutput.write(b"  ")
-        tree.write(self.rawOutput, encoding='utf-8')
-        self.rawOutput.write(b"\n") 
-    
-    
-    
     def _extractMetadata(self):
         """ Extracts meta-data on the subtitle and the conversion process,
         in order to append it to the end of the XML file.
@@ -499,48 +587,36 @@ class SubtitleConverter:
         
         if self.curBlock:
             meta["subtitle"]["blocks"] = str(self.curBlock.id)
-            meta["subtitle"]["duration"] = self.curBlock.end
+            meta["subtitle"]["duration"] = self.curBlock.endStr
    
         meta["conversion"]["sentences"] = str(self.sid)
         meta["conversion"]["tokens"] = str(self.nbTokens)
         meta["conversion"]["encoding"] = self.encodings[0]
+        if self.detection:
+            meta["conversion"]["detected_encoding"] = self.detection[0]
+            meta["conversion"]["inspected_bytes"] = str(self.detection[1])
         meta["conversion"]["ignored_blocks"] = str(self.nbIgnoredBlocks)
+        meta["conversion"]["fast_timings"] = str(self.nbFastTimings)
+        meta["conversion"]["regex_timings"] = str(self.nbSlowTimings)
         sc = self.spellchecker
         meta["conversion"]["unknown_words"] = str(sc.nbUnknowns)
         meta["conversion"]["corrected_words"] = str(sc.nbCorrections)
         meta["conversion"]["truecased_words"] = str(sc.nbTruecased)
+        cache = self.tokeniser.cache
+        meta["conversion"]["tokeniser_cache_hits"] = str(cache.hits - self.cacheCounts[0])
+        meta["conversion"]["tokeniser_cache_misses"] = str(cache.misses - self.cacheCounts[1])
         return meta
     
     
     def _flushDocument(self):
-        """ Adds the final meta-data to the XML file, and closes the XML document.
+        """ Adds the final meta-data to the output file(s), and closes the document.
         
         """
         self._flushSentence()
         meta = self._extractMetadata()
-        metaBuilder = et.TreeBuilder()
-        metaBuilder.start("meta")
-        
-        for part in meta:
-            metaBuilder.data("\n    ")
-            metaBuilder.start(part)
-            if isinstance(meta[part],dict):
-                for key in meta[part]:
-                    metaBuilder.data("\n      ")
-                    metaBuilder.start(key)
-                    metaBuilder.data(meta[part][key])
-                    metaBuilder.end(key)
-            metaBuilder.data("\n    ")
-            metaBuilder.end(part)
-        
-        metaBuilder.data("\n  ")   
-        metaBuilder.end("meta")
-        tree = et.ElementTree(metaBuilder.close())
-        for fd in [self.output,self.rawOutput]:
-            if fd:
-                fd.write(b"  ")
-                tree.write(fd, encoding='utf-8')
-                fd.write(b"\n</document>\n") 
+        self.writer.endDocument(meta)
+        if self.rawWriter:
+            self.rawWriter.endDocument(meta)
                 
     
     def closeOutputs(self):           
@@ -551,32 +627,54 @@ class SubtitleConverter:
                 
 
 class Sentence:
-    """Representation of a tokenised sentence (with time stamps).
+    """Representation of a tokenised sentence (with time stamps). The entities
+    of the sentence are tuples ("w", token, emphasised, initial, alternative)
+    for the tokens and ("time", identifier, timing in ms, time string) for 
+    the stamps.
     
     """
+    __slots__ = ("entities", "lastToken", "rawParts", "correctedParts", 
+                 "nbTokens", "nbStamps", "nbEmphasised")
     
     def __init__(self):
         self.entities = []
         self.lastToken = None
-        self.raw = ""  
-        self.rawCorrected = ""  
+        self.rawParts = []  
+        self.correctedParts = []  
+        self.nbTokens = 0
+        self.nbStamps = 0
+        self.nbEmphasised = 0
         
     def addToken(self, token, emphasised, initial=None, alternative=None):
-        emphasis = "true" if emphasised else None
-        attrs = {"emphasis":emphasis,"initial":initial,"alternative":alternative}
-        attrs = {k:attrs[k] for k in attrs if attrs[k]}
-        self.entities.append(("w", token, attrs))
+        self.entities.append(("w", token, bool(emphasised), initial, alternative))
+        self.nbTokens += 1
+        if emphasised:
+            self.nbEmphasised += 1
         corrected = alternative if alternative else token
         self.lastToken = corrected
-        self.raw += token
-        self.rawCorrected += corrected
+        self.rawParts.append(token)
+        self.correctedParts.append(corrected)
     
     def addRawChar(self, c):
-        self.raw += c
-        self.rawCorrected += c
+        if c:
+            self.rawParts.append(c)
+            self.correctedParts.append(c)
+        
+    def addStamp(self, stamp, timing, value=None):
+        """Adds a time stamp, with its timing in milliseconds and the time 
+        string to output (by default, the timing in the HH:MM:SS,mmm format)."""
+        self.entities.append(("time", stamp, timing, value or formatTime(timing)))
+        self.nbStamps += 1
         
-    def addStamp(self, stamp, timing):
-        self.entities.append(("time", {"id":stamp,"value":timing}))
+    def removeEntity(self, index):
+        """Removes the entity at the given index."""
+        entity = self.entities.pop(index)
+        if entity[0]=="w":
+            self.nbTokens -= 1
+            if entity[2]:
+                self.nbEmphasised -= 1
+        else:
+            self.nbStamps -= 1
         
     def getStamps(self):
         return [x for x in self.entities if x[0]=="time"]
@@ -585,18 +683,27 @@ class Sentence:
         return [x for x in self.entities if x[0]=="w"]
     
     def getNbStamps(self):
-        return len(self.getStamps())
+        return self.nbStamps
     
     def getNbTokens(self):
-        return len(self.getTokens())
+        return self.nbTokens
     
     def isEmphasised(self):
-        foundToken = False
-        for x in self.entities:
-            if x[0]=="w" and "emphasis" not in x[2]:
-                return False
-            foundToken=True
-        return foundToken
+        return bool(self.entities) and self.nbEmphasised == self.nbTokens
+    
+    @property
+    def raw(self):
+        """Returns the untokenised sentence."""
+        return "".join(self.rawParts)
+    
+    @raw.setter
+    def raw(self, raw):
+        self.rawParts = [raw] if raw else []
+    
+    @property
+    def rawCorrected(self):
+        """Returns the untokenised sentence, with the spelling corrections."""
+        return "".join(self.correctedParts)
 
     def __nonzero__(self):
         return bool(self.entities)
@@ -611,7 +718,9 @@ class BilingualConverter(SubtitleConverter):
     """
 
     def __init__(self, input, output, output2, rawOutput=None,rawOutput2=None, 
-                 language=None,language2=None, meta=None, encoding=None, alwaysSplit=False):
+                 language=None,language2=None, meta=None, encoding=None, alwaysSplit=False,
+                 tokeniser=None, spellchecker=None, tokeniser2=None, spellchecker2=None,
+                 outputFormat="xml", stream=False):
         """Creates a new converter for a given input and output (as file
         objects). A second file object for the raw output can also be provided.
         
@@ -619,21 +728,42 @@ class BilingualConverter(SubtitleConverter):
             output2(file object): XML file for second language
             rawOutput2(file object): XML file for second language
             language2(Language object): second language
+            tokeniser2(Tokeniser object): caller-owned tokeniser for the second language
+            spellchecker2(SpellChecker object): caller-owned spellchecker for 
+                the second language
         
         The other arguments are similar to the SubtitleConverter.
         
         """                 
-        SubtitleConverter.__init__(self, input, output, rawOutput, language, 
-                                   meta, encoding, alwaysSplit)
+        SubtitleConverter.__init__(self, input, output, rawOutput, language, meta, 
+                                   encoding, alwaysSplit, tokeniser, spellchecker, 
+                                   outputFormat, stream)
         self.encodings += language2.encodings
-        detected = detectEncoding(self.inputs[0], self.encodings)
-        self.encodings = [detected] + self.encodings
+        self.detection = detectEncoding(self.inputs[0], self.encodings)
+        self.encodings = [self.detection[0]] + self.encodings
             
         self.lang2 = language2
         self.output2 = output2
         self.rawOutput2 = rawOutput2
+        self.writer2 = writers[outputFormat](output2)
+        self.rawWriter2 = writers[outputFormat](rawOutput2, True) if rawOutput2 else None
+        self.sharedTokeniser2 = tokeniser2
+        self.sharedSpellchecker2 = spellchecker2
           
          
+    def _tokeniseBlocks(self, blocks):
+        """Tokenises the lines of the blocks, where the first line of each 
+        block is in the first language, and the other lines in the second.
+        
+        """
+        firstLines = iter(self.tokeniser.tokeniseLines([b.lines[0] for b in blocks if b.lines]))
+        otherLines = self.tokeniser2.tokeniseLines([l for b in blocks for l in b.lines[1:]])
+        start = 0
+        for block in blocks:
+            if block.lines:
+                block.tokens = [next(firstLines)] + otherLines[start:start+len(block.lines)-1]
+                start += len(block.lines)-1
+         
     
     def doConversion(self):   
         """Performs the conversion process, reading the full subtitle file
@@ -643,10 +773,13 @@ class BilingualConverter(SubtitleConverter):
         self.text2 = ""            
         self.nbTokens2 = 0
         self.sid2 = 0
-        self.tokeniser2 = Tokeniser(self.lang2)
-        self.spellchecker2 = SpellChecker(self.lang2)
+        self.tokeniser2 = self.sharedTokeniser2 or Tokeniser(self.lang2)
+        self.spellchecker2 = self.sharedSpellchecker2 or SpellChecker(self.lang2)
+        self.spellchecker2.resetCounters()
+        self.cacheCounts2 = (self.tokeniser2.cache.hits, self.tokeniser2.cache.misses)
         SubtitleConverter.doConversion(self) 
-        self.tokeniser2.close()        
+        if not self.sharedTokeniser2:
+            self.tokeniser2.close()        
         
         
     def _startDocument(self):
@@ -673,9 +806,9 @@ class BilingualConverter(SubtitleConverter):
         # Loops on each line of the subtitle block
         for linenum in range(0,len(block.lines)):
             self.sentence = Sentence()
-            self.sentence.addStamp("T%sS"%block.id, block.start)
+            self.sentence.addStamp("T%sS"%block.id, block.start, block.startStr)
             self._recordLine(block, linenum)  
-            self.sentence.addStamp("T%sE"%block.id, block.start)
+            self.sentence.addStamp("T%sE"%block.id, block.start, block.startStr)
             self._flushSentence()
             if not linenum:
                 self._switchLanguage()
@@ -687,12 +820,15 @@ class BilingualConverter(SubtitleConverter):
     def _switchLanguage(self):
         self.output, self.output2 = self.output2, self.output
         self.rawOutput, self.rawOutput2 = self.rawOutput2, self.rawOutput
+        self.writer, self.writer2 = self.writer2, self.writer
+        self.rawWriter, self.rawWriter2 = self.rawWriter2, self.rawWriter
         self.text, self.text2 = self.text2, self.text
         self.nbTokens, self.nbTokens2 = self.nbTokens2, self.nbTokens
         self.lang, self.lang2 = self.lang2, self.lang
         self.sid, self.sid2 = self.sid2, self.sid
         self.tokeniser, self.tokeniser2 = self.tokeniser2, self.tokeniser
         self.spellchecker, self.spellchecker2 = self.spellchecker2, self.spellchecker
+        self.cacheCounts, self.cacheCounts2 = self.cacheCounts2, self.cacheCounts
          
 
     def closeOutputs(self):           
@@ -715,42 +851,86 @@ class SubtitleBlock:
         self.lines = []
         self.start = None
         self.end = None
+        self.startStr = None
+        self.endStr = None
         self.previous = None
         self.offset = 0
         self.tags = []
+        self.spans = None
         self.id = 0
+        self.tokens = None
         
     def setId(self, id):
         """Sets the block identifier. """
         self.id = id
          
-    def setTiming(self, start, end):
-        """Sets the timing for the block (in seconds). """
-        self.start = addsecs(start, self.offset)
-        self.end = addsecs(end, self.offset)      
+    def setTiming(self, start, end, startStr=None, endStr=None):
+        """Sets the timing for the block (in milliseconds), along with the 
+        start and end time strings from the file, which are kept for the
+        outputs unless the timing is shifted by an offset. """
+        self.start = start + self.offset
+        self.end = end + self.offset
+        if self.offset or startStr is None or endStr is None:
+            startStr, endStr = formatShiftedTime(self.start), formatShiftedTime(self.end)
+        self.startStr, self.endStr = startStr, endStr
+        
+    def shiftTiming(self, shift):
+        """Shifts the timing of the block by a number of milliseconds. """
+        if shift:
+            self.start += shift
+            self.end += shift
+            self.startStr = formatShiftedTime(self.start)
+            self.endStr = formatShiftedTime(self.end)
     
     def addLine(self, line):
         """Adds the line to the block. The method also strips html tags,
         spurious characters and punctuations, and non-standard quotation marks.
         
         """
+        self.spans = None
         line = line.strip()
-        splits = re.split(r"\\[nN]", line)
-        if len(splits) > 1:
-            for s in splits:
-                self.addLine(s)
-            return
+        if "\\" in line:
+            splits = re.split(r"\\[nN]", line)
+            if len(splits) > 1:
+                for s in splits:
+                    self.addLine(s)
+                return
         if not line:
             return
-        line = quotationRegex.sub("\"", line)  
-        line = quotationRegex2.sub("'", line)  
-        line = tagRegex2.sub("<i>\g<1></i>", line)
-        line = tagRegex3.sub("<i>\g<1></i>", line)
-        line = re.sub(r"{[\w\\]+}", "", line)
-        line = line.replace("…", "...").replace("‥", "...")
-        line = toReduceRegex.sub("\g<1>", line)
+        
+        # Lines with srt-type tags need several passes, the others only one
+        if "{" in line:
+            line = cleanLine(line)
+        else:
+            line = cleaningRegex.sub(lambda m : m.group(1) or cleaningTable[m.group()], line)
        
-        # Search for emphasis tags
+        if "<" in line or ">" in line:
+            line = self._extractTags(line)
+        elif "&" in line:
+            line = line.replace("&", "")
+        self.lines.append(line)
+        
+        
+    def _extractTags(self, line):
+        """Removes the html tags from the line, records the emphasis tags (with
+        their positions in the line without tags), and strips the remaining
+        &, < and > characters.
+        
+        """
+        # If all < and > characters are part of tags, the tags can be removed
+        # in one scan 
+        matches = list(tagRegex.finditer(line))
+        starts = [0] + [m.end() for m in matches]
+        ends = [m.start() for m in matches] + [len(line)]
+        rest = [line[start:end] for start, end in zip(starts, ends)]
+        if matches and not [r for r in rest if "<" in r or ">" in r]:
+            removed = 0
+            for m in matches:
+                self.tags.append((len(self.lines), m.start()-removed, "/" not in m.group()))
+                removed += m.end() - m.start()
+            return "".join(rest).replace("&", "")
+        
+        # Otherwise, searches for emphasis tags one by one
         ematch = tagRegex.search(line)
         while ematch:
             pos, tag = ematch.start(), ematch.group()
@@ -759,8 +939,7 @@ class SubtitleBlock:
             ematch = tagRegex.search(line)
  
         line = tagRegex.sub("", line)
-        line = tostripRegex.sub("", line)  
-        self.lines.append(line)
+        return tostripRegex.sub("", line)  
         
    
     def isEmphasised(self, linenum, position): 
@@ -769,15 +948,35 @@ class SubtitleBlock:
         subtitle block.
         
         """
-        for i, tag1 in enumerate(self.tags):
-            if tag1[2]:          
-                tag2 = next(iter([t for t in self.tags[i+1:] if not t[2]]), None)
-                if tag2 and (linenum >=tag1[0] and linenum <=tag2[0] and 
-                        (position >= tag1[1] or linenum > tag1[0]) and 
-                        (position <=tag2[1] or linenum < tag2[0])):
-                     return True
-        return False
+        if self.spans is None:
+            self._resolveSpans()
+        point = (linenum, position)
+        i = bisect.bisect_right(self.spans, (point, (sys.maxsize, sys.maxsize))) - 1
+        return i >= 0 and point <= self.spans[i][1]
+    
     
+    def _resolveSpans(self):
+        """Pairs each opening tag with the first closing tag after it, and
+        merges the resulting emphasised spans (from (line, position) to
+        (line, position), both inclusive) into a sorted list of disjoint 
+        spans.
+        
+        """
+        spans = []
+        closing = None
+        for tag in reversed(self.tags):
+            if not tag[2]:
+                closing = tag
+            elif closing and (tag[0], tag[1]) <= (closing[0], closing[1]):
+                spans.append(((tag[0], tag[1]), (closing[0], closing[1])))
+        self.spans = []
+        for start, end in sorted(spans):
+            if self.spans and start <= self.spans[-1][1]:
+                self.spans[-1] = (self.spans[-1][0], max(end, self.spans[-1][1]))
+            else:
+                self.spans.append((start, end))
+        
+        
     def __str__(self):
         """Returns a string representation of the block.
         
@@ -785,8 +984,8 @@ class SubtitleBlock:
         s = ""
         if self.id:
             s += str(self.id) + "\n"
-        if self.start and self.end:
-            s += self.start + " --> " + self.end + "\n"
+        if self.start is not None and self.end is not None:
+            s += self.startStr + " --> " + self.endStr + "\n"
         s += "\n".join(self.lines)
         return s
     
@@ -797,7 +996,7 @@ class SubtitleBlock:
         previous block).
         
         """
-        if not self.start or not self.end:
+        if self.start is None or self.end is None:
             return True
         for l in self.lines:
             l2 = l.lower()
@@ -816,7 +1015,8 @@ class SubtitleBlock:
         
 
 def convertSubtitle(srtFile=None, xmlFile=None, langcode=None,encoding=None, 
-                    alwaysSplit=False, rawOutput=None,meta=None):
+                    alwaysSplit=False, rawOutput=None,meta=None, outputFormat="xml",
+                    stream=False):
     """Converts a .srt subtitle to the XML representation.  
     
     Args:
@@ -832,6 +1032,10 @@ def convertSubtitle(srtFile=None, xmlFile=None, langcode=None,encoding=None,
             output. Leave to None to avoid generating this output.
         meta(dict): Meta-data about the subtitle to write at the end of the 
             XML file(s).
+        outputFormat(str): format of the output file(s): xml (default), 
+            text, jsonl or binary
+        stream(bool): whether to decode the subtitle file chunk by chunk 
+            (with bounded memory) instead of in full
             
     """
     if srtFile:
@@ -849,19 +1053,24 @@ def convertSubtitle(srtFile=None, xmlFile=None, langcode=None,encoding=None,
         lang = utils.getLanguage("zht")
         lang2 = utils.getLanguage("eng")      
         converter = BilingualConverter([input], output,output2,rawOutput,rawOutput2,
-                                       lang,lang2, meta, encoding, alwaysSplit) 
+                                       lang,lang2, meta, encoding, alwaysSplit,
+                                       outputFormat=outputFormat, stream=stream) 
     else:    
         lang = utils.getLanguage(langcode) if langcode else None
         converter = SubtitleConverter([input],output,rawOutput,lang,
-                                  meta, encoding,alwaysSplit)
+                                  meta, encoding,alwaysSplit, outputFormat=outputFormat,
+                                  stream=stream)
     converter.doConversion()
     converter.closeOutputs()
         
      
      
 def detectEncoding(input, alternatives):
-    """Tries to detected the encoding using chardet.  The detection
-    is performed incrementally.
+    """Tries to detect the encoding of the file, and returns it along with 
+    the number of bytes that were inspected. The detection first looks for 
+    a byte order mark, then checks whether the start of the file (up to 
+    ENCODING_SAMPLE bytes) is valid UTF-8, and only then runs chardet on 
+    this sample.
     
     Args:
         - input(file object): the file object with the content
@@ -869,66 +1078,122 @@ def detectEncoding(input, alternatives):
             
     """
     if not input or not hasattr(input,"fileno"):
-        return "utf-8"
+        return "utf-8", 0
+    sample = input.read(ENCODING_SAMPLE)
+    input.seek(0)
+    
+    for bom, encoding in [(codecs.BOM_UTF8, "utf-8"), (codecs.BOM_UTF16_LE, "utf-16"), 
+                          (codecs.BOM_UTF16_BE, "utf-16")]:
+        if sample.startswith(bom):
+            sys.stderr.write("Detected encoding: %s (byte order mark)\n"%encoding)
+            return encoding, len(bom)
     try:
-        from chardet.universaldetector import UniversalDetector
-    except RuntimeError:
+        # The sample may end in the middle of a character
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+        sys.stderr.write("Detected encoding: utf-8 (valid on %i bytes)\n"%len(sample))
+        return "utf-8", len(sample)
+    except UnicodeDecodeError:
+        pass
+        
+    try:
+        import chardet
+    except ImportError:
         sys.stderr.write("Cannot find chardet\n")
-        return "utf-8"
+        return "utf-8", len(sample)
 
-    detector = UniversalDetector()
-    for line in input.readlines():
-        detector.feed(line)
-        if detector.done: break
-    detector.close()
-    input.seek(0)
-    
-    if "encoding" in detector.result and detector.result["encoding"]:
-        encoding = detector.result["encoding"].lower().rstrip("-sig")
+    result = chardet.detect(sample)
+    if "encoding" in result and result["encoding"]:
+        encoding = result["encoding"].lower().rstrip("-sig")
         # Correcting some detection errors in chardet
         encoding = "windows-1250" if encoding=="iso-8859-2" else encoding
         encoding = "windows-1252" if encoding=="asc" else encoding
         encoding = "shiftjis" if encoding=="shift_j" else encoding
-        confidence = detector.result['confidence']
+        confidence = result['confidence']
     else:
         encoding = "unknown"
         confidence = 0.0
     
     sys.stderr.write("Detected encoding: %s with confidence %f\n"
-                     %(encoding, detector.result['confidence']))
+                     %(encoding, confidence))
     if confidence > 0.3 and (not alternatives or encoding in alternatives):
-        return encoding
+        return encoding, len(sample)
     else:
         raise RuntimeError("Unsupported encoding %s (not in %s)"
                            %(encoding,str(alternatives)))
       
 
-def tosecs(timeStr):
-    """ Convert the time string as a number of seconds.
+def cleanLine(line):
+    """ Replaces non-standard quotation marks, rewrites the srt-type tags into
+    html tags, removes the other srt-type tags, and reduces ellipses and 
+    repeated punctuations in the line (in several passes).
     
     """
-    if not timeStr:
-        return 0
-    split = re.split("[^0-9\-]",timeStr)
-    split = [s for s in split if s]
-    if len(split) >=3:
-        secs = 3600*int(split[0]) + 60*int(split[1]) + int(split[2])
-    else:
+    line = quotationRegex.sub("\"", line)  
+    line = quotationRegex2.sub("'", line)  
+    line = tagRegex2.sub("<i>\g<1></i>", line)
+    line = tagRegex3.sub("<i>\g<1></i>", line)
+    line = re.sub(r"{[\w\\]+}", "", line)
+    line = line.replace("…", "...").replace("‥", "...")
+    return toReduceRegex.sub("\g<1>", line)
+
+def parseNumber(line):
+    """ Returns the number on the line if the line only contains a number
+    (as the subtitle indices), and None otherwise. This is equivalent to
+    matching numberRegex.
+    
+    """
+    if line.endswith("\n"):
+        number = line[:-1].rstrip("\r")
+        if number.isdecimal():
+            return int(number)
+    return None
+
+def parseCanonicalTiming(line):
+    """ Returns the start and end times (in milliseconds) if the line is a 
+    timing line in the canonical layout HH:MM:SS,mmm --> HH:MM:SS,mmm (with
+    a comma or dot before the milliseconds), and None otherwise.
+    
+    """
+    line = line.strip()
+    if (len(line) != 29 or line[12:17] != " --> " or line[2] != ":" or line[5] != ":"
+        or line[19] != ":" or line[22] != ":" or line[8] not in ",." 
+        or line[25] not in ",."):
+        return None
+    digits = (line[0:2], line[3:5], line[6:8], line[9:12], 
+              line[17:19], line[20:22], line[23:25], line[26:29])
+    joined = "".join(digits)
+    if not joined.isascii() or not joined.isdecimal():
+        return None
+    h1, m1, s1, ms1, h2, m2, s2, ms2 = [int(d) for d in digits]
+    return (1000*(3600*h1 + 60*m1 + s1) + ms1, 1000*(3600*h2 + 60*m2 + s2) + ms2)
+
+def tomillis(timeStr):
+    """ Converts the time string to a number of milliseconds (0 if the 
+    string cannot be parsed).
+    
+    """
+    split = [s for s in re.split("[^0-9\-]",timeStr) if s] if timeStr else []
+    if len(split) < 3:
         return 0
+    millis = 1000*(3600*int(split[0]) + 60*int(split[1]) + int(split[2]))
     if len(split)==4:
-        secs += int(split[3])/1000.0
-    return secs
+        millis += int(split[3])
+    return millis
 
-def addsecs(timeStr, offset):
-    """ Adds a number of seconds to the given time string.
+def formatShiftedTime(millis):
+    """ Formats the time (in milliseconds) of a shifted timing as a time 
+    string HH:MM:SS,mmm (where the seconds are not zero-padded).
     
     """
-    if not offset:
-        return timeStr
-    totalSecs = tosecs(timeStr) + offset
-    m, s = divmod(totalSecs, 60)
+    m, s = divmod(millis, 60000)
     h, m = divmod(m, 60)
-    return "%02d:%02d:"%(h,m) + ("%.3f"%s).replace(".",",")
+    return "%02d:%02d:"%(h,m) + ("%.3f"%(s/1000.0)).replace(".",",")
+
+def tosecs(timeStr):
+    """ Convert the time string as a number of seconds.
+    
+    """
+    return tomillis(timeStr)/1000.0
 
  
         
@@ -953,6 +1218,10 @@ if __name__ == '__main__':
                           help="always start a new sentence at new time frames (default is false)")
  
     cmdOptions.add_argument("-m", dest="meta", help="meta-data")
+    cmdOptions.add_argument("-f", dest="outputFormat", default="xml", choices=sorted(writers),
+                          help="output format (default is xml)")
+    cmdOptions.add_argument("--stream", dest="stream", action='store_true', 
+                          help="decode the subtitle file chunk by chunk (bounded memory)")
 
 
     args = vars(cmdOptions.parse_args())
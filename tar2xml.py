@@ -1,20 +1,78 @@
 # -*- coding: utf-8 -*- 
 
 import gzip,tarfile,re,os,sys,io,tarfile,time,collections,uuid,subprocess
+import multiprocessing,multiprocessing.util,tempfile,shutil,heapq,threading
 from io import BytesIO
 from gzip import GzipFile
 from tarfile import TarInfo
 import xml.etree.ElementTree as et
-import utils
+import utils, catalog
 from srt2xml import SubtitleConverter, BilingualConverter
+from writers import writers
+from utils import Tokeniser, SpellChecker
 
 exportFile = "/projects/researchers/researchers01/plison/data/export_all.txt"
 infoFile = "/projects/researchers/researchers01/plison/data/subtitles_all.txt"
 omdbFile = "/projects/researchers/researchers01/plison/data/omdb.txt"
 ratingFile = "/projects/researchers/researchers01/plison/data/sub_attributes.csv"
+catalogFile = "/projects/researchers/researchers01/plison/data/catalog.sqlite"
 sub2srt = os.path.dirname(os.path.abspath(__file__)) + "/sub2srt.pl"
 ssa2srt = os.path.dirname(os.path.abspath(__file__)) + "/ssa2srt.pl"
 
+# Size (in bytes) above which the outputs are spilled to temporary files in
+# streaming mode
+SPILL_SIZE = 16*1024*1024
+
+# Fixed cost of each subtitle file (in compressed bytes) when balancing the
+# partitions, on top of its compressed size
+FILE_COST = 4096
+
+# Default maximum size (in bytes) of the decompressed content held in the 
+# prefetch queue (see Prefetcher)
+PREFETCH_BYTES = 64*1024*1024
+
+
+class MemberReader(io.RawIOBase):
+    """Read-only file object over the (compressed) content of a member of 
+    the archive, which reads the data on demand with os.pread. Several readers 
+    can thus share the same file descriptor without holding the content in 
+    memory.
+    
+    """
+    
+    def __init__(self, fd, offset, size):
+        self.fileno_ = fd.fileno()
+        self.offset = offset
+        self.size = size
+        self.position = 0
+        
+    def readable(self):
+        return True
+    
+    def seekable(self):
+        return True
+    
+    def readinto(self, buffer):
+        length = min(len(buffer), self.size - self.position)
+        if length <= 0:
+            return 0
+        data = os.pread(self.fileno_, length, self.offset + self.position)
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+    
+    def seek(self, position, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            position += self.position
+        elif whence == io.SEEK_END:
+            position += self.size
+        self.position = max(0, min(position, self.size))
+        return self.position
+    
+    def tell(self):
+        return self.position
+
+
 class Subtitle:
     
     def __init__(self, subid, imdb, langcode, format, numcds, date, year):
@@ -31,13 +89,21 @@ class Subtitle:
     def addFilePointer(self, fileid, cdnum, fd, offset, size):
         self.files[cdnum-1] = (fileid, fd, offset, size)
    
-    def getFileObjects(self):
+    def getFileObjects(self, stream=False):
+        """Returns the (decompressed) file objects for the subtitle files. In
+        streaming mode, the compressed content is read and decompressed on
+        demand instead of being loaded in memory.
+        
+        """
         inputs = []
         for f in self.files:
             if f:
                 fileid, fd, offset,size = f    
-                fd.seek(offset,0)
-                content = BytesIO(fd.read(size))
+                if stream:
+                    content = io.BufferedReader(MemberReader(fd, offset, size))
+                else:
+                    fd.seek(offset,0)
+                    content = BytesIO(fd.read(size))
                 input = GzipFile(fileid,'rb',fileobj=content)
                 try:
                     firstline = input.readline().decode("utf-8","ignore")
@@ -68,6 +134,24 @@ class Subtitle:
                 inputs.append(input) 
         return inputs
     
+    
+    def attachArchive(self, fd):
+        """Attaches the file pointers of the subtitle to the (binary) file
+        object of the source archive.
+        
+        """
+        self.files = [(f[0], fd, f[2], f[3]) if f else None for f in self.files]
+        
+        
+    def __getstate__(self):
+        """Drops the archive file objects when the subtitle is sent to a 
+        worker process (which attaches its own, see attachArchive).
+        
+        """
+        state = dict(self.__dict__)
+        state["files"] = [(f[0], None, f[2], f[3]) if f else None for f in self.files]
+        return state
+    
      
     def __eq__(self, other):
         if hasattr(other,"subid"):
@@ -122,64 +206,49 @@ class Subtitle:
 
 
 
-def extractSubtitles():
+def extractSubtitles(rows=None):
+    """Returns the subtitles indexed by language and subtitle identifier, 
+    from the rows of the subtitle table (if None, reads the flat file).
     
+    """
     subtitles = {}
-    fd = open(infoFile, 'r')
-    fd.readline()
-    for line in fd:
-        split = line.split('\t')
-        if len(split) == 16:
-            subid = split[0]
-            year = split[2]
-            langcode = split[4]
-            imdb = split[6]
-            subformat = split[7]
-            sumcds = int(split[8])
-            date = split[5].split(" ")[0]
-            sub = Subtitle(subid, imdb, langcode, subformat, sumcds,date, year)
-            if split[10]:
-                sub.fps = float(split[10])
-            if langcode not in subtitles:
-                subtitles[langcode] = {}
-            subtitles[langcode][subid] = sub
-    fd.close()
+    if rows is None:
+        rows = catalog.readInfoFile(infoFile)
+    for langcode, subid, imdb, subformat, sumcds, date, year, fps in rows:
+        sub = Subtitle(subid, imdb, langcode, subformat, sumcds,date, year)
+        if fps:
+            sub.fps = float(fps)
+        if langcode not in subtitles:
+            subtitles[langcode] = {}
+        subtitles[langcode][subid] = sub
     
     return subtitles
 
 
 
-def addFilePointers(subset, archive):
+def addFilePointers(subset, archive, db=None):
         
-    export = open(exportFile, 'r')
+    if db:
+        rows = db.getRows("files", subset.keys())
+    else:
+        rows = catalog.readExportFile(exportFile)
     files = {}
     cdproblems = 0
-    for l in export:
-        split = l.rstrip().split('\t')
-        if len(split)>=6:
-            subid = split[3]
-            fileid = split[1]
-            if fileid and split[4]:
-                cdnum = int(split[4])
-                if subid in subset:
-                    if cdnum < 1 or cdnum > len(subset[subid].files):
-                        cdproblems += 1
-                        continue
-                    files[fileid] = (subid,cdnum)
+    for subid, fileid, cdnum in rows:
+        if subid in subset:
+            if cdnum < 1 or cdnum > len(subset[subid].files):
+                cdproblems += 1
+                continue
+            files[fileid] = (subid,cdnum)
     sys.stderr.write("Number of discarded subtitles: %i\n"%cdproblems)    
-    export.close()
     
-    fdtar = tarfile.open(archive, mode='r')
+    # Looking up the members in the index of the archive (in archive order)
+    index = catalog.getArchiveIndex(archive)
+    members = sorted((index[fileId], fileId) for fileId in files if fileId in index)
     fdbin = open(archive, mode='rb')
-    for subfile in fdtar:
-        fileId = os.path.basename(subfile.name).split(".")[0]
-        if fileId in files:
-            subid, cdnum = files[fileId]
-            if subid in subset:
-                sub = subset[subid]
-                offset,size = subfile.offset_data, subfile.size
-                sub.addFilePointer(fileId, cdnum, fdbin, offset, size)
-    fdtar.close()
+    for (offset, size), fileId in members:
+        subid, cdnum = files[fileId]
+        subset[subid].addFilePointer(fileId, cdnum, fdbin, offset, size)
    
 
 def addNumCds(subset):
@@ -194,7 +263,7 @@ def addNumCds(subset):
  
          
 
-def addOmdbInfo(subset):   
+def addOmdbInfo(subset, db=None):   
     imdbs = {}
     for sub in subset.values():
         imdb = sub.imdb
@@ -203,99 +272,208 @@ def addOmdbInfo(subset):
         else:
             imdbs[imdb].append(sub)
             
-    fd = open(omdbFile, 'r', encoding="latin-1")
-    fd.readline()
-    for line in fd:
-        split = line.split('\t')
-        imdb = split[0]
+    if db:
+        rows = db.getRows("sources", imdbs.keys())
+    else:
+        rows = catalog.readOmdbFile(omdbFile)
+    for imdb, year, duration, genre, original, country in rows:
         if imdb in imdbs:
             for sub in imdbs[imdb]:
-                sub.meta["source"]["year"]=split[3]
-                sub.meta["source"]["duration"]=split[5]
-                sub.meta["source"]["genre"]=split[6]
-                sub.meta["source"]["original"]=split[17]
-                sub.meta["source"]["country"]=split[18]
-    fd.close()
+                sub.meta["source"]["year"]=year
+                sub.meta["source"]["duration"]=duration
+                sub.meta["source"]["genre"]=genre
+                sub.meta["source"]["original"]=original
+                sub.meta["source"]["country"]=country
                 
 
 
-def addRatingInfo(subset):   
+def addRatingInfo(subset, db=None):   
 
-    fd = open(ratingFile, 'r')
-    for line in fd:
-        split = line.split(',')
-        subId = split[0].strip("\"")
+    if db:
+        rows = db.getRows("ratings", subset.keys())
+    else:
+        rows = catalog.readRatingFile(ratingFile)
+    for subId, nbBad, avgScore, nbVotes, member in rows:
         if subId in subset:
             sub = subset[subId]    
-            nbBad = int(split[1].strip("\""))
-            avgScore = float(split[2].strip("\""))
-            nbVotes = int(split[3].strip("\""))
-            member = split[4].strip("\"")
+            nbBad = int(nbBad)
+            avgScore = float(avgScore)
+            nbVotes = int(nbVotes)
             rating = (-10 * nbBad) + ((avgScore-5) * nbVotes)
             rating += 2 if member=="trusted" or member=="subtranslator" else 0
             sub.meta["subtitle"]["rating"] = str(rating)
-    fd.close()
 
    
 
 def _addToArchive(output, filename, archive):
-    output.seek(0)
     xmlInfo = TarInfo(filename)
-    xmlInfo.size = len(output.getbuffer())
+    xmlInfo.size = output.seek(0, io.SEEK_END)
+    output.seek(0)
     xmlInfo.mtime = time.time()
     archive.addfile(xmlInfo,output)    
     output.close()
  
  
  
-def selectSubtitles(archiveFile, langcode, nbPartitions, part):   
+def getWeight(sub):
+    """Returns the weight of the subtitle for balancing the partitions, which
+    is the compressed size of its files plus a fixed cost per file.
+    
+    """
+    return sum(f[3] + FILE_COST for f in sub.files if f)
+
+
+def balancePartitions(subtitles_list, nbPartitions):
+    """Splits the subtitles (with their file pointers) into partitions of
+    similar total weight, using a greedy longest-processing-time assignment:
+    the subtitles are sorted by decreasing weight (ties being broken by their
+    position in the list) and each is assigned to the lightest partition 
+    (ties being broken by the partition number). The assignment is thus 
+    deterministic for a given list. The subtitles keep their relative order
+    within each partition.
+    
+    """
+    weights = [getWeight(s) for s in subtitles_list]
+    order = sorted(range(len(subtitles_list)), key=lambda i: (-weights[i], i))
+    loads = [(0, p) for p in range(nbPartitions)]
+    assignment = [0]*len(subtitles_list)
+    for i in order:
+        load, p = heapq.heappop(loads)
+        assignment[i] = p
+        heapq.heappush(loads, (load + weights[i], p))
+    
+    partitions = [[] for _ in range(nbPartitions)]
+    for i, sub in enumerate(subtitles_list):
+        partitions[assignment[i]].append(sub)
+    return partitions
+
+
+def printPlan(partitions, part):
+    """Prints the plan of the partitions (with the selected one marked)."""
+    sys.stderr.write("Partition plan:\n")
+    for p, subs in enumerate(partitions):
+        nbFiles = sum(len([f for f in s.files if f]) for s in subs)
+        size = sum(f[3] for s in subs for f in s.files if f)
+        sys.stderr.write("%s part %i: %i subtitles, %i files, %i bytes, weight %i\n"
+                         %("-->" if p+1 == part else "   ", p+1, len(subs), nbFiles, size,
+                           sum(getWeight(s) for s in subs)))
+
+
+def selectSubtitles(archiveFile, langcode, nbPartitions, part, catalogFile=None,
+                    balanced=False):   
+    """Selects the subtitles of the language in the given partition, and adds
+    their file pointers and meta-data. The rows are queried from the catalog
+    if it exists and is up to date, and read from the flat files otherwise.
+    
+    The partitions contain the same number of subtitles, or if balanced is
+    true, are balanced according to the compressed size and number of files
+    of their subtitles (see balancePartitions).
+    
+    """
+    db = catalog.openCatalog(catalogFile, [infoFile, exportFile, omdbFile, ratingFile])
 
     sys.stderr.write("Reading the subtitle table...\n")    
-    subtitles = extractSubtitles()
+    if db:
+        subtitles = extractSubtitles(db.getSubtitles(langcode))
+    else:
+        subtitles = extractSubtitles()
     subtitles_list = list(subtitles[langcode].values())
-    partlength = int(len(subtitles_list)/nbPartitions)
-    partstart = (part-1)*partlength
-    partend = part*partlength if part < nbPartitions else len(subtitles_list)
-    subset = {s.subid:s for s in subtitles_list[partstart:partend]}
-    
     sys.stderr.write("Finished reading the subtitle table.\n")
-    sys.stderr.write("Reading the export and archive file...\n")
-    addFilePointers(subset, archiveFile)
-    sys.stderr.write("Finished reading the archive file.\n")
+    
+    if balanced:
+        # The file pointers of all subtitles are needed to balance the partitions
+        sys.stderr.write("Reading the export and archive file...\n")
+        addFilePointers({s.subid:s for s in subtitles_list}, archiveFile, db)
+        sys.stderr.write("Finished reading the archive file.\n")
+        partitions = balancePartitions(subtitles_list, nbPartitions)
+        printPlan(partitions, part)
+        subset = {s.subid:s for s in partitions[part-1]}
+    else:
+        partlength = int(len(subtitles_list)/nbPartitions)
+        partstart = (part-1)*partlength
+        partend = part*partlength if part < nbPartitions else len(subtitles_list)
+        subset = {s.subid:s for s in subtitles_list[partstart:partend]}
+        sys.stderr.write("Reading the export and archive file...\n")
+        addFilePointers(subset, archiveFile, db)
+        sys.stderr.write("Finished reading the archive file.\n")
+        
     sys.stderr.write("Reading the additional databases...\n")
     addNumCds(subset)
-    addOmdbInfo(subset)
-    addRatingInfo(subset)
+    addOmdbInfo(subset, db)
+    addRatingInfo(subset, db)
+    if db:
+        db.close()
     sys.stderr.write("Finished reading the databases.\n")
 
     nbSubtitles = sum([len([f for f in s.files if f]) for s in subset.values()])
     sys.stderr.write("--> Processing %i subtitles (code: %s)\n"%(nbSubtitles,langcode))
     return subset
+
+
+def orderSubtitles(subset, sequential=False):
+    """Returns the list of subtitles in the order in which they should be
+    processed. If sequential is true, the subtitles are sorted by the archive
+    offset of their first file, such that the archive is read sequentially 
+    (the subtitles without files come last, in their original order).
+    
+    """
+    subtitles = list(subset.values())
+    if sequential:
+        def getOffset(sub):
+            offsets = [f[2] for f in sub.files if f]
+            return (0, offsets[0]) if offsets else (1, 0)
+        subtitles.sort(key=getOffset)
+    return subtitles
  
  
   
-def addSubtitle(sub, tokTarFile, rawTarFile, language, encoding, alwaysSplit):
+def _newOutput(spill=None):
+    """Returns an in-memory output, or in streaming mode (when the spill size
+    is set) an output that is spilled to a temporary file above this size.
+    
+    """
+    return tempfile.SpooledTemporaryFile(spill) if spill is not None else BytesIO()
 
+  
+def _convertSubtitle(sub, language, encoding, alwaysSplit, withRaw=False, tools=None,
+                     outputFormat="xml", spill=None, inputs=None):
+    """Converts the subtitle and returns its outputs as a list of (index, path, 
+    file object) triples, where the index is 0 for the tokenised output and 1 
+    for the raw output. The list is empty if the subtitle cannot be converted.
+    
+    Args:
+        tools(dict): (Tokeniser, SpellChecker) pairs indexed by language, to 
+            reuse across subtitles (if None, new ones are created)
+        outputFormat(str): format of the outputs (see writers.writers)
+        spill(int): spill size of the outputs in streaming mode (if None, the
+            subtitle is converted in memory)
+        inputs(list): file objects for the subtitle files, if already read
+            (see Prefetcher). If None, the files are read from the archive
+    
+    """
     srtFiles = ", ".join([s[0]+"."+sub.subformat for s in sub.files if s])
     if not srtFiles:
         sys.stderr.write(sub.subid + " not in archive\n")
-        return
-    path = sub.year + "/" + sub.imdb + "/" + sub.subid + ".xml"
+        return []
+    path = sub.year + "/" + sub.imdb + "/" + sub.subid + "." + writers[outputFormat].extension
     sys.stderr.write("Processing %s (output file: %s)\n"%(srtFiles, path))
 
-    input = sub.getFileObjects()  
+    input = inputs if inputs is not None else sub.getFileObjects(spill is not None)  
     if not input:
-        return              
-    output = BytesIO()
-    routput = BytesIO() if rawTarFile else None
+        return []              
+    output = _newOutput(spill)
+    routput = _newOutput(spill) if withRaw else None
+    tokeniser, spellchecker = tools.get(language, (None,None)) if tools else (None,None)
 
+    results = []
     try:
-        converter = SubtitleConverter(input,output,routput,language,sub.meta, 
-                                      encoding, alwaysSplit)  
+        converter = SubtitleConverter(list(input),output,routput,language,sub.meta, 
+                                      encoding, alwaysSplit, tokeniser, spellchecker,
+                                      outputFormat, spill is not None)  
         converter.doConversion()
-        _addToArchive(output,path,tokTarFile)
-        if rawTarFile:
-            _addToArchive(routput,path,rawTarFile)
+        results.append((0, path, output))
+        if withRaw:
+            results.append((1, path, routput))
     except KeyboardInterrupt:
         raise
     except:
@@ -303,45 +481,65 @@ def addSubtitle(sub, tokTarFile, rawTarFile, language, encoding, alwaysSplit):
               
     for i in input:
         i.close()
-    output.close()
-    if rawTarFile:
-        routput.close()
+    return results
+        
+        
+def addSubtitle(sub, tokTarFile, rawTarFile, language, encoding, alwaysSplit, tools=None,
+                outputFormat="xml", spill=None, inputs=None):
 
+    results = _convertSubtitle(sub, language, encoding, alwaysSplit, bool(rawTarFile), tools,
+                               outputFormat, spill, inputs)
+    _addResults(results, [tokTarFile, rawTarFile])
 
-def addBilingualSubtitle(sub, tokTarFile,tokTarFile2, rawTarFile, rawTarFile2,
-                        language, language2, encoding, alwaysSplit):
 
+def _convertBilingualSubtitle(sub, language, language2, encoding, alwaysSplit,
+                              withRaw=False, tools=None, outputFormat="xml", spill=None,
+                              inputs=None):
+    """Converts the bilingual subtitle and returns its outputs as a list of 
+    (index, path, file object) triples, where the index is 0 and 1 for the 
+    tokenised outputs in the two languages, and 2 and 3 for the raw outputs.
+    
+    """
     srtFiles = ", ".join([s[0]+"."+sub.subformat for s in sub.files if s])
     if not srtFiles:
         sys.stderr.write(sub.subid + " not in archive\n")
-        return
-    path = sub.year + "/" + sub.imdb + "/" + sub.subid + ".xml"
+        return []
+    path = sub.year + "/" + sub.imdb + "/" + sub.subid + "." + writers[outputFormat].extension
     sys.stderr.write("Processing %s (output files: %s)\n"%(srtFiles, path))
 
-    input = sub.getFileObjects()  
+    input = inputs if inputs is not None else sub.getFileObjects(spill is not None)  
     if not input:
-        return              
-    output = BytesIO()
-    output2 = BytesIO()
-    routput = BytesIO() if rawTarFile else None
-    routput2 = BytesIO() if rawTarFile else None
-
+        return []              
+    output = _newOutput(spill)
+    output2 = _newOutput(spill)
+    routput = _newOutput(spill) if withRaw else None
+    routput2 = _newOutput(spill) if withRaw else None
+    tokeniser, spellchecker = tools.get(language, (None,None)) if tools else (None,None)
+    tokeniser2, spellchecker2 = tools.get(language2, (None,None)) if tools else (None,None)
+
+    results = []
     try:
-        converter = BilingualConverter(input,output,output2,routput,routput2,
-                                       language,language2, sub.meta, encoding, alwaysSplit)  
+        converter = BilingualConverter(list(input),output,output2,routput,routput2,
+                                       language,language2, sub.meta, encoding, alwaysSplit,
+                                       tokeniser, spellchecker, tokeniser2, spellchecker2,
+                                       outputFormat, spill is not None)  
         converter.doConversion()
 
         if (language.getProb(converter.text) < language2.getProb(converter.text) and
             language2.getProb(converter.text2) < language.getProb(converter.text2)):
             sys.stderr.write("Erroneous language ordering, re-processing subtitle...\n")
-            addBilingualSubtitle(sub, tokTarFile2, tokTarFile, rawTarFile2, rawTarFile,
-                                 language2, language, encoding, alwaysSplit)
+            for i in input:
+                i.seek(0)
+            swapped = _convertBilingualSubtitle(sub, language2, language, encoding, 
+                                                alwaysSplit, withRaw, tools, outputFormat,
+                                                spill, input)
+            results = [(index + (1 if index%2==0 else -1), p, o) for index, p, o in swapped]
         else:                 
-            _addToArchive(output,path,tokTarFile)
-            _addToArchive(output2,path,tokTarFile2)
-            if rawTarFile:
-                _addToArchive(routput,path,rawTarFile)
-                _addToArchive(routput2,path,rawTarFile2)
+            results.append((0, path, output))
+            results.append((1, path, output2))
+            if withRaw:
+                results.append((2, path, routput))
+                results.append((3, path, routput2))
     except KeyboardInterrupt:
         raise
     except:
@@ -349,37 +547,300 @@ def addBilingualSubtitle(sub, tokTarFile,tokTarFile2, rawTarFile, rawTarFile2,
               
     for i in input:
         i.close()
-    output.close()
-    output2.close()
-    if rawTarFile:
-        routput.close()
-        routput2.close()
+    return results
+
+
+def addBilingualSubtitle(sub, tokTarFile,tokTarFile2, rawTarFile, rawTarFile2,
+                        language, language2, encoding, alwaysSplit, tools=None,
+                        outputFormat="xml", spill=None, inputs=None):
 
+    results = _convertBilingualSubtitle(sub, language, language2, encoding, 
+                                        alwaysSplit, bool(rawTarFile), tools, outputFormat,
+                                        spill, inputs)
+    _addResults(results, [tokTarFile, tokTarFile2, rawTarFile, rawTarFile2])
+
+        
+def _addResults(results, tarFiles):
+    """Adds the conversion outputs to their respective tar files."""
+    
+    for index, path, output in results:
+        _addToArchive(output, path, tarFiles[index])
+        
+
+class Prefetcher:
+    """Reads and decompresses the files of the next subtitles in a background
+    thread, such that the reads from the source archive overlap with the 
+    conversion of the current subtitle. The prefetched subtitles are held in
+    a queue bounded by their number and by the total size of their content 
+    (a single subtitle larger than this size is still prefetched alone). The
+    prefetcher is iterated to get the (subtitle, file objects) pairs in the
+    original order.
+    
+    """
+    
+    def __init__(self, subtitles, maxCount, maxBytes=PREFETCH_BYTES):
+        self.subtitles = subtitles
+        self.maxCount = maxCount
+        self.maxBytes = maxBytes
+        self.queue = collections.deque()
+        self.nbBytes = 0
+        self.finished = False
+        self.stopped = False
+        self.waitTime = 0.0
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._prefetch, daemon=True)
+        self.thread.start()
+        
+    
+    def _isFull(self):
+        return bool(self.queue) and (len(self.queue) >= self.maxCount 
+                                     or self.nbBytes >= self.maxBytes)
+    
+    
+    def _prefetch(self):
+        """Reads the subtitles in turn (in the background thread)."""
+        for sub in self.subtitles:
+            with self.condition:
+                while self._isFull() and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    break
+            inputs, size = self._read(sub)
+            with self.condition:
+                self.queue.append((sub, inputs, size))
+                self.nbBytes += size
+                self.condition.notify_all()
+        with self.condition:
+            self.finished = True
+            self.condition.notify_all()
+            
+    
+    def _read(self, sub):
+        """Returns the decompressed file objects for the subtitle, with their 
+        total size.
+        
+        """
+        if not [f for f in sub.files if f]:
+            return None, 0
+        inputs = []
+        try:
+            for input in sub.getFileObjects():
+                content = BytesIO(input.read())
+                if hasattr(input, "name"):
+                    content.name = input.name
+                inputs.append(content)
+                input.close()
+        except Exception:
+            sys.stderr.write("Prefetching error: %s\n"%sys.exc_info()[1])
+            return [], 0
+        return inputs, sum(len(i.getbuffer()) for i in inputs)
+        
+    
+    def __iter__(self):
+        while True:
+            with self.condition:
+                start = time.time()
+                while not self.queue and not self.finished:
+                    self.condition.wait()
+                self.waitTime += time.time() - start
+                if not self.queue:
+                    return
+                sub, inputs, size = self.queue.popleft()
+                self.nbBytes -= size
+                self.condition.notify_all()
+            yield sub, inputs
+            
+    
+    def close(self):
+        """Stops the background thread and reports the time spent waiting for 
+        the prefetched subtitles.
+        
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.thread.join()
+        sys.stderr.write("Time spent waiting for the prefetched subtitles: %.1f s\n"
+                         %self.waitTime)
+        
+
+def _iterSubtitles(subtitles, prefetch=0, prefetchBytes=PREFETCH_BYTES, stream=False):
+    """Returns an iterator over (subtitle, file objects) pairs, where the file
+    objects are prefetched in the background (up to the given number of 
+    subtitles and bytes) if prefetch is set, and are None otherwise. The 
+    prefetching is disabled in streaming mode, since it holds the content of
+    the subtitles in memory.
+    
+    """
+    if prefetch and stream:
+        sys.stderr.write("Prefetching is disabled in streaming mode\n")
+    elif prefetch:
+        return Prefetcher(subtitles, prefetch, prefetchBytes)
+    return ((sub, None) for sub in subtitles)
+
+
+def _openResult(content):
+    """Returns a file object for an output sent back by a worker process, 
+    which is either the content itself (as bytes) or the path of the 
+    temporary file where it was spilled (removed once opened).
+    
+    """
+    if isinstance(content, bytes):
+        return BytesIO(content)
+    output = open(content, 'rb')
+    os.remove(content)
+    return output
+        
+        
+def startTools(languages):
+    """Starts a long-lived tokeniser session and a spellchecker for each 
+    language, to be reused across all subtitles of the archive. Returns
+    a dictionary of (Tokeniser, SpellChecker) pairs indexed by language.
+    
+    """
+    return {l:(Tokeniser(l), SpellChecker(l)) for l in languages}
+
+
+def closeTools(tools):
+    """Closes the tokeniser sessions started with startTools, and reports
+    the statistics of their caches.
+    
+    """
+    for language, (tokeniser, spellchecker) in tools.items():
+        sys.stderr.write("Tokenisation cache (%s): %s\n"%(language, tokeniser.cache))
+        sys.stderr.write("Scoring cache (%s): %s\n"%(language, spellchecker.scoreCache))
+        sys.stderr.write("Spellchecking cache (%s): %s\n"%(language, spellchecker.decisionCache))
+        tokeniser.close()
+    sys.stderr.write(utils.getResourceReport())
+        
+
+# State of the current worker process (see _convertInPool)
+_worker = {}
+
+def _initWorker(archiveFile, langcodes, encoding, alwaysSplit, withRaw, outputFormat, 
+                spill):
+    """Initialises a worker process, with its own handle on the source archive
+    and its own tokeniser and spellchecker for each language. The tools are
+    closed when the worker process exits.
+    
+    """
+    languages = [utils.getLanguage(l) for l in langcodes]
+    _worker["archive"] = open(archiveFile, mode='rb')
+    _worker["languages"] = languages
+    _worker["tools"] = startTools(languages)
+    multiprocessing.util.Finalize(None, closeTools, args=(_worker["tools"],), 
+                                  exitpriority=10)
+    _worker["options"] = (encoding, alwaysSplit, withRaw, outputFormat, spill)
+    
+    
+def _convertInWorker(sub):
+    """Converts the subtitle in the worker process, and returns the outputs
+    as (index, path, content) triples to be written by the parent process. 
+    The content is either the bytes of the output or, for outputs above the
+    spill size (in streaming mode), the path of a temporary file.
+    
+    """
+    sub.attachArchive(_worker["archive"])
+    encoding, alwaysSplit, withRaw, outputFormat, spill = _worker["options"]
+    languages, tools = _worker["languages"], _worker["tools"]
+    try:
+        if len(languages) == 2:
+            results = _convertBilingualSubtitle(sub, languages[0], languages[1], encoding,
+                                                alwaysSplit, withRaw, tools, outputFormat,
+                                                spill)
+        else:
+            results = _convertSubtitle(sub, languages[0], encoding, alwaysSplit, 
+                                       withRaw, tools, outputFormat, spill)
+    except KeyboardInterrupt:
+        return []
+    converted = []
+    for index, path, output in results:
+        size = output.seek(0, io.SEEK_END)
+        output.seek(0)
+        if spill is not None and size > spill:
+            with tempfile.NamedTemporaryFile(suffix=".spill", delete=False) as spilled:
+                shutil.copyfileobj(output, spilled)
+            converted.append((index, path, spilled.name))
+        else:
+            converted.append((index, path, output.read()))
+        output.close()
+    return converted
+    
+    
+def _convertInPool(archiveFile, subtitles, langcodes, tarFiles, encoding, 
+                   alwaysSplit, workers, outputFormat="xml", spill=None):
+    """Converts the subtitles in a pool of worker processes.  The parent 
+    process remains the only writer of the output tar files.
+    
+    """
+    withRaw = tarFiles[-1] is not None
+    sys.stderr.write("Starting %i worker processes\n"%workers)
+    pool = multiprocessing.Pool(workers, _initWorker, 
+                                (archiveFile, langcodes, encoding, alwaysSplit, withRaw,
+                                 outputFormat, spill))
+    try:
+        for results in pool.imap(_convertInWorker, subtitles):
+            _addResults([(i, p, _openResult(c)) for i, p, c in results], tarFiles)
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+    pool.join()
         
  
 def convertArchive(archiveFile, tokTarFile, langcode=None, encoding=None, 
-                   alwaysSplit=False, rawTarFile=None, nbPartitions=1, part=1):
+                   alwaysSplit=False, rawTarFile=None, nbPartitions=1, part=1,
+                   workers=1, outputFormat="xml", stream=False, spillSize=SPILL_SIZE,
+                   catalogFile=None, balanced=False, sequential=False, prefetch=0,
+                   prefetchBytes=PREFETCH_BYTES):
+    """Converts the subtitles of the archive (or of one of its partitions).
+    In streaming mode, the subtitles are decompressed and decoded on demand, 
+    and the outputs above the spill size (in bytes) are spilled to temporary 
+    files, such that oversized subtitles are converted with bounded memory.
+    The meta-data are queried from the catalog (see catalog.py) if provided, 
+    and the partitions are balanced by size if balanced is true. If sequential 
+    is true, the subtitles are processed in the order of the archive. If 
+    prefetch is set (without worker processes), the given number of subtitles 
+    are read ahead in a background thread (see Prefetcher).
     
+    """
     if not langcode:
         langcode = re.search(r'([^/]+)\.tar',archiveFile).group(1) 
     if langcode == "zhe":
         return convertBilingualArchive(archiveFile,tokTarFile,langcode,encoding,
-                                       alwaysSplit,rawTarFile,nbPartitions,part)
+                                       alwaysSplit,rawTarFile,nbPartitions,part,
+                                       workers, outputFormat, stream, spillSize,
+                                       catalogFile, balanced, sequential, prefetch,
+                                       prefetchBytes)
     
     langcode=utils.getLanguage(langcode).codes[0] if langcode !="pob" else "pb"
-    subset = selectSubtitles(archiveFile, langcode, nbPartitions, part)
+    subset = selectSubtitles(archiveFile, langcode, nbPartitions, part, catalogFile,
+                             balanced)
+    subtitles = orderSubtitles(subset, sequential)
     
     language = utils.getLanguage(langcode)  
+    spill = spillSize if stream else None
     
     tokTarFile = tarfile.open(tokTarFile, mode='w')
     if rawTarFile:
         rawTarFile = tarfile.open(rawTarFile, mode='w')
-            
-    for sub in subset.values():             
-        try:  
-            addSubtitle(sub, tokTarFile, rawTarFile, language, encoding, alwaysSplit)          
-        except KeyboardInterrupt:
-            break
+    
+    if workers > 1:
+        _convertInPool(archiveFile, subtitles, [langcode], [tokTarFile, rawTarFile],
+                       encoding, alwaysSplit, workers, outputFormat, spill)
+    else:
+        tools = startTools([language])
+        try:
+            subtitles = _iterSubtitles(subtitles, prefetch, prefetchBytes, stream)
+            for sub, inputs in subtitles:             
+                try:  
+                    addSubtitle(sub, tokTarFile, rawTarFile, language, encoding, 
+                                alwaysSplit, tools, outputFormat, spill, inputs)          
+                except KeyboardInterrupt:
+                    break
+        finally:
+            if isinstance(subtitles, Prefetcher):
+                subtitles.close()
+            closeTools(tools)
 
     tokTarFile.close() 
     if rawTarFile:
@@ -387,12 +848,17 @@ def convertArchive(archiveFile, tokTarFile, langcode=None, encoding=None,
 
 
 def convertBilingualArchive(archiveFile, tokTarFile, langcode=None, encoding=None, 
-                   alwaysSplit=False, rawTarFile=None, nbPartitions=1, part=1):
+                   alwaysSplit=False, rawTarFile=None, nbPartitions=1, part=1,
+                   workers=1, outputFormat="xml", stream=False, spillSize=SPILL_SIZE,
+                   catalogFile=None, balanced=False, sequential=False, prefetch=0,
+                   prefetchBytes=PREFETCH_BYTES):
            
 
     language = utils.getLanguage("zht") 
     language2 = utils.getLanguage("eng")         
-    subset = selectSubtitles(archiveFile, "ze", nbPartitions, part)
+    subset = selectSubtitles(archiveFile, "ze", nbPartitions, part, catalogFile, balanced)
+    subtitles = orderSubtitles(subset, sequential)
+    spill = spillSize if stream else None
     
     incrementPath = lambda p : re.sub("(\w+)(?=\.|$|\-raw\.)", "\g<1>2", p, 1)
     tokTarFile = tarfile.open(tokTarFile, mode='w')
@@ -403,12 +869,25 @@ def convertBilingualArchive(archiveFile, tokTarFile, langcode=None, encoding=Non
     else:
         rawTarFile2 = None
         
-    for sub in subset.values():             
-        try:  
-            addBilingualSubtitle(sub,tokTarFile,tokTarFile2,rawTarFile,rawTarFile2, 
-                                 language, language2, encoding, alwaysSplit)                     
-        except KeyboardInterrupt:
-            break
+    if workers > 1:
+        _convertInPool(archiveFile, subtitles, ["zht", "eng"], 
+                       [tokTarFile, tokTarFile2, rawTarFile, rawTarFile2],
+                       encoding, alwaysSplit, workers, outputFormat, spill)
+    else:
+        tools = startTools([language, language2])
+        try:
+            subtitles = _iterSubtitles(subtitles, prefetch, prefetchBytes, stream)
+            for sub, inputs in subtitles:             
+                try:  
+                    addBilingualSubtitle(sub,tokTarFile,tokTarFile2,rawTarFile,rawTarFile2, 
+                                         language, language2, encoding, alwaysSplit, tools,
+                                         outputFormat, spill, inputs)                     
+                except KeyboardInterrupt:
+                    break
+        finally:
+            if isinstance(subtitles, Prefetcher):
+                subtitles.close()
+            closeTools(tools)
 
     tokTarFile.close() 
     tokTarFile2.close() 
@@ -438,6 +917,26 @@ if __name__ == '__main__':
                             help="Number of partitions for processing the archive file")
     cmdOptions.add_argument("-p", dest="part", default=1, type=int,
                             help="Part to process in the partitioned archive")
+    cmdOptions.add_argument("--balanced", dest="balanced", action='store_true',
+                            help="Balance the partitions by compressed size and number of files")
+    cmdOptions.add_argument("--sequential", dest="sequential", action='store_true',
+                            help="Process the subtitles in the order of the source archive")
+    cmdOptions.add_argument("--prefetch", dest="prefetch", default=0, type=int,
+                            help="Number of subtitles read ahead in a background thread")
+    cmdOptions.add_argument("--prefetch-bytes", dest="prefetchBytes", default=PREFETCH_BYTES, 
+                            type=int, help="Maximum size (in bytes) of the prefetched subtitles")
+    cmdOptions.add_argument("--workers", dest="workers", default=1, type=int,
+                            help="Number of worker processes for the conversion")
+    cmdOptions.add_argument("-f", dest="outputFormat", default="xml", choices=sorted(writers),
+                            help="Format of the converted subtitles (default is xml)")
+    cmdOptions.add_argument("--stream", dest="stream", action='store_true',
+                            help="Convert the subtitles with bounded memory (streaming mode)")
+    cmdOptions.add_argument("--spill", dest="spillSize", default=SPILL_SIZE, type=int,
+                            help="Output size (in bytes) above which the outputs are spilled "
+                            + "to temporary files in streaming mode")
+    cmdOptions.add_argument("--catalog", dest="catalogFile", default=catalogFile,
+                            help="Path to the metadata catalog built with catalog.py "
+                            + "(the flat files are read if it is missing or out of date)")
 
 
     args = vars(cmdOptions.parse_args())
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+"""Regression test of the line cleaner of srt2xml. The corpus holds one
+subtitle block per line (in JSON), with the raw input lines and the cleaned
+lines, tag positions and emphasis flags (one per character position of each
+cleaned line) produced by the original cleaner.
+
+"""
+
+import os, sys, json, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import srt2xml
+
+corpusFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cleaning_corpus.jsonl")
+
+
+class CleaningTest(unittest.TestCase):
+
+    def test_corpus(self):
+        with open(corpusFile, 'r', encoding="utf-8") as fd:
+            entries = [json.loads(line) for line in fd]
+        self.assertTrue(entries)
+        for entry in entries:
+            with self.subTest(input=entry["input"]):
+                block = srt2xml.SubtitleBlock()
+                for line in entry["input"]:
+                    block.addLine(line)
+                self.assertEqual(block.lines, entry["lines"])
+                self.assertEqual([list(tag) for tag in block.tags], entry["tags"])
+                emphasis = ["".join("1" if block.isEmphasised(i, pos) else "0"
+                                    for pos in range(len(line)+1))
+                            for i, line in enumerate(block.lines)]
+                self.assertEqual(emphasis, entry["emphasis"])
+
+
+if __name__ == '__main__':
+    unittest.main()
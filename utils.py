@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*- 
 
-import os, json, io, collections, re, unicodedata, sys, errno, math
+import os, json, io, collections, re, unicodedata, sys, errno, math, threading, time
+import mmap, struct, array, hashlib
 from subprocess import Popen, PIPE
 
 # Language data (codes, names, encodings, scripts, dictionaries)
@@ -152,27 +153,44 @@ languages = {'alb': 'sq', 'scc': 'sr', 'ita': 'it', 'per': 'fa', 'gl': {'codes':
 # Path to tokenisation script
 tokeniserPath = "/cluster/home/plison/mt/mosesdecoder/scripts/tokenizer/tokenizer.perl"
 
+# Path to the non-breaking prefixes used by the tokenisation script
+prefixesPath = os.path.dirname(tokeniserPath) + "/../share/nonbreaking_prefixes"
+
+# Default number of tokenised lines kept in the cache of each tokeniser
+tokenisationCacheSize = 100000
+
+# Default number of scores and spellchecking decisions kept in the caches of 
+# each spellchecker
+scoringCacheSize = 200000
+
 # Path and models for the Kytea sentence segmentation tool
 kyteaPath = "/cluster/home/plison/mt/kytea"
 kyteaModels = {"ja": "/cluster/home/plison/mt/kytea/models/jp-0.4.7-5.mod",
                "zh": "/cluster/home/plison/mt/kytea/models/lcmc-0.4.0-1.mod"}
 
-os.environ["LD_LIBRARY_PATH"] += ":" + kyteaPath + "/lib"
+os.environ["LD_LIBRARY_PATH"] = (os.environ.get("LD_LIBRARY_PATH", "") 
+                                  + ":" + kyteaPath + "/lib")
        
 class Tokeniser():
     """Tokeniser (and spelling corrector)."""
     
-    def __init__(self, language=None):
+    def __init__(self, language=None, engine=None, cacheSize=None):
         """Initialises the tokeniser and dictionary for a particular language.
         
         Args:
             language(Language object): language for the tokeniser (None if unknown).
+            engine(str): "moses" to run the tokenisation script, or "python" to
+                use the in-process MosesTokeniser. If None, uses the engine 
+                of the language, or the script if it can be found.
+            cacheSize(int): maximum number of tokenised lines to keep in the 
+                cache (if None, uses tokenisationCacheSize).
         
         """
         
         # Starts a process with the tokeniser tool
         if isinstance(language,str):
            language = getLanguage(language)
+        self.engine = None
         if language and "Japanese" in language.name:
             self.cmd = kyteaPath + "/bin/kytea -notags -model " + kyteaModels["ja"]
         elif language and "Chinese" in language.name:
@@ -180,28 +198,144 @@ class Tokeniser():
         else:
             self.cmd = tokeniserPath + " -no-escape -q -b "
             self.cmd += ("-l %s" % language.codes[0] if language else "")       
-        self.tokprocess = Popen(self.cmd, 1, shell=True, stdin=PIPE, stdout=PIPE)
+            engine = engine or (language.tokeniser if language else None)
+            if engine == "python" or (not engine and not os.path.exists(tokeniserPath)):
+                self.engine = MosesTokeniser(language.codes[0] if language else "en")
+        self._start()
         
         self.language = language
+        self.cache = LRUCache(tokenisationCacheSize if cacheSize is None else cacheSize)
          
+         
+    def _start(self):
+        """Starts (or restarts) the process running the tokeniser tool."""
+        
+        if self.engine:
+            self.tokprocess = None
+            return
+        self.tokprocess = Popen(self.cmd, 1, shell=True, stdin=PIPE, stdout=PIPE)
+        
+        
+    def _restart(self):
+        """Restarts the process running the tokeniser tool after it has 
+        stopped, closing the pipes of the stopped process and reaping it.
+        
+        """
+        sys.stderr.write("Tokeniser process has stopped, restarting it\n")
+        self.close()
+        self._start()
+        
+        
+    def _write(self, text):
+        """Sends the text to the tokeniser process. The process is restarted
+        if it has died in the meantime (the session is otherwise kept alive
+        across sentences and subtitles).  Returns false if the text could
+        not be sent.
+        
+        """
+        for attempt in range(0,2):
+            if self.tokprocess.poll() != None:
+                self._restart()
+            try:
+                self.tokprocess.stdin.write(text.encode('utf-8'))
+                self.tokprocess.stdin.flush()
+                return True
+            except IOError as e:
+                sys.stderr.write("Error: " + str(e) + "\n")
+                if e.errno != errno.EPIPE and e.errno != errno.EINVAL:
+                    raise
+        return False
+  
   
     def tokenise(self, sentence):
         """Tokenises the given sentence and corrects the tokens 
-        with OCR errors or misplaced accents
+        with OCR errors or misplaced accents. The tokens are looked up 
+        in the cache of previously tokenised lines first.
         
         """
-        try:
-            self.tokprocess.stdin.write((sentence + "\n").encode('utf-8'))
-            self.tokprocess.stdin.flush()
-        except IOError as e:
-            sys.stderr.write("Error: " + str(e) + "\n")
-            if e.errno == errno.EPIPE or e.errno == errno.EINVAL:
-                return []
-            else:
-                raise
+        tokens = self.cache.get(sentence)
+        if tokens is None:
+            tokens = self._tokenise(sentence)
+            if tokens:
+                self.cache.put(sentence, tokens)
+        return tokens
+    
+    
+    def tokeniseLines(self, lines):
+        """Tokenises a list of lines and returns the list of tokens for each
+        line. The lines that are not already in the cache are tokenised in 
+        one single exchange with the tokeniser process.
+        
+        """
+        tokenised = [self.cache.get(l) for l in lines]
+        missing = list(dict.fromkeys([l for l, t in zip(lines, tokenised) if t is None]))
+        results = dict(zip(missing, self._tokeniseBatch(missing)))
+        for line in missing:
+            if results[line]:
+                self.cache.put(line, results[line])
+        return [t if t is not None else results[l] for l, t in zip(lines, tokenised)]
+    
+    
+    def _tokenise(self, sentence):
+        """Tokenises the sentence with the tokeniser tool (without caching)."""
+        
+        if self.engine:
+            return self._splitTokens(self.engine.tokenise(sentence))
+        if not self._write(sentence + "\n"):
+            return []
         if self.tokprocess.poll() == None:
             sentence = self.tokprocess.stdout.readline().decode('utf-8')
+        return self._splitTokens(sentence)
+    
+    
+    def _tokeniseBatch(self, lines):
+        """Tokenises a list of lines in one single exchange with the tokeniser
+        process, and returns the list of tokens for each line. The lines are
+        delimited by newlines, and the tokeniser outputs one line for each 
+        input line. 
+        
+        """
+        if not lines:
+            return []
+        if self.engine:
+            return [self._splitTokens(self.engine.tokenise(l)) for l in lines]
+        if self.tokprocess.poll() != None:
+            self._restart()
+        process = self.tokprocess
+        text = "".join([l.replace("\n", " ") + "\n" for l in lines])
+        
+        # The lines are written from a separate thread, to avoid a deadlock 
+        # when the output pipe is full before the input is entirely written
+        def feed():
+            try:
+                process.stdin.write(text.encode('utf-8'))
+                process.stdin.flush()
+            except IOError as e:
+                sys.stderr.write("Error: " + str(e) + "\n")
+        writer = threading.Thread(target=feed)
+        writer.daemon = True
+        writer.start()
         
+        tokenised = []
+        while len(tokenised) < len(lines):
+            output = process.stdout.readline()
+            if not output:
+                break
+            tokenised.append(self._splitTokens(output.decode('utf-8')))
+        writer.join()
+        
+        # If the process has died in the middle, tokenises the remaining lines
+        # one by one (restarting the process)
+        for line in lines[len(tokenised):]:
+            tokenised.append(self._tokenise(line))
+        return tokenised
+    
+    
+    def _splitTokens(self, sentence):
+        """Splits the output of the tokeniser tool into a list of tokens, and 
+        corrects the tokenisation of dashes.
+        
+        """
         sentence = sentence.replace(". . .", "...")
         if "kytea" in self.cmd:
             sentence = sentence.replace("\\", "")
@@ -226,28 +360,274 @@ class Tokeniser():
     def close(self):
         """Closes the tokenisation processes."""
         
+        if not self.tokprocess:
+            return
         self.tokprocess.terminate()
-        self.tokprocess.stdin.close()
-        self.tokprocess.stdout.close()
+        for pipe in [self.tokprocess.stdin, self.tokprocess.stdout]:
+            try:
+                pipe.close()
+            except IOError:
+                pass
+        self.tokprocess.wait()
+    
+class LRUCache():
+    """Bounded cache that evicts its least recently used entries, and counts 
+    its number of hits and misses.
+    
+    """
+    
+    def __init__(self, maxSize):
+        """Initialises an empty cache with the given maximum size."""
+        
+        self.maxSize = maxSize
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        
+        
+    def get(self, key):
+        """Returns the value for the key, or None if the key is not cached."""
+        
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return value
+    
+    
+    def put(self, key, value):
+        """Adds the value to the cache, and evicts the oldest entry if the 
+        cache is full.
+        
+        """
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+            
+            
+    def __len__(self):
+        """Returns the number of cached entries."""
+        return len(self.entries)
+    
+    
+    def __str__(self):
+        """Returns the cache statistics."""
+        return ("%i entries, %i hits, %i misses, %i evictions"
+                %(len(self.entries), self.hits, self.misses, self.evictions))
+    
+
+# Non-breaking prefixes for the in-process tokeniser, when the files from the
+# Moses distribution are not available (abridged versions of the Moses lists).
+# For each language, the second string contains the prefixes that are only
+# non-breaking when followed by a number.
+_capitals = " ".join([chr(c) for c in range(ord("A"), ord("Z")+1)])
+nonBreakingPrefixes = {
+    "en": (_capitals + " Adj Adm Adv Asst Bart Bldg Brig Bros Capt Cmdr Col Comdr Con"
+           " Corp Cpl DR Dr Drs Ens Gen Gov Hon Hr Hosp Insp Lt MM MR MRS MS Maj Messrs"
+           " Mlle Mme Mr Mrs Ms Msgr Op Ord Pfc Ph Prof Pvt Rep Reps Res Rev Rt Sen Sens"
+           " Sfc Sgt Sr St Supt Surg v vs i.e rev e.g Jan Feb Mar Apr Jun Jul Aug Sep"
+           " Sept Oct Nov Dec", "No Nos Art Nr pp"),
+    "fr": (_capitals + " M MM Mme Mmes Mlle Mlles Me Dr Pr St Ste Sts Stes cf etc ex"
+           " janv févr avr juil sept oct nov déc", "No no n° p pp"),
+    "de": (_capitals + " Dr Prof Hr Fr Frl Dipl Ing St bzw ca evtl ggf inkl usw vgl"
+           " z.B d.h u.a Jan Feb Mär Apr Jun Jul Aug Sep Sept Okt Nov Dez", "Nr Art S"),
+    "es": (_capitals + " Sr Sra Srta Sres Dr Dra Ud Uds Vd Vds Lic Ing Prof Profa Sto"
+           " Sta etc ej pág", "No núm"),
+    "it": (_capitals + " Sig Sigg Dott Dr Prof Avv Ing Geom Rag On Sen Egr Gent ecc"
+           " es pag", "No n"),
+    "pt": (_capitals + " Sr Sra Srta Dr Dra Prof Profa Exmo Exma Eng Av pág etc ex",
+           "No n nº"),
+    "nl": (_capitals + " Dhr Mevr Mej Dr Drs Ir Mr Prof St bijv bv enz etc jl mvr ca",
+           "Nr nr blz"),
+}
+
+_prefixTables = {}
+
+def getNonBreakingPrefixes(langcode):
+    """Returns the non-breaking prefixes for the language (code), as a
+    dictionary mapping each prefix to 1 (always non-breaking) or 2 (only
+    before numbers). The prefixes are read from the Moses distribution if
+    available, and otherwise from the built-in lists.  Like the Moses script, 
+    falls back to the English prefixes for unknown languages.
+    
+    """
+    if langcode in _prefixTables:
+        return _prefixTables[langcode]
+    prefixes = {}
+    prefixFile = prefixesPath + "/nonbreaking_prefix." + langcode
+    if os.path.exists(prefixFile):
+        with io.open(prefixFile, encoding="utf-8") as fd:
+            for item in fd:
+                item = item.strip()
+                if item and not item.startswith("#"):
+                    match = re.match(r"(.*)[\s]+(\#NUMERIC_ONLY\#)", item)
+                    if match:
+                        prefixes[match.group(1)] = 2
+                    else:
+                        prefixes[item] = 1
+    elif langcode in nonBreakingPrefixes:
+        always, numeric = nonBreakingPrefixes[langcode]
+        prefixes.update({p:1 for p in always.split()})
+        prefixes.update({p:2 for p in numeric.split()})
+    elif langcode != "en":
+        prefixes = getNonBreakingPrefixes("en")
+    _prefixTables[langcode] = prefixes
+    return prefixes
+
+
+# Precompiled regexes for the in-process tokeniser (where \p{IsAlnum} in the
+# Moses script becomes [^\W_] and \p{IsAlpha} becomes [^\W\d_])
+junkRegex = re.compile(r"[\000-\037]")
+specialCharRegex = re.compile(r"([^\w\s\.\'\`\,\-]|_)")
+multiDotRegex = re.compile(r"\.([\.]+)")
+multiDotRegex2 = re.compile(r"DOTMULTI\.([^\.])")
+commaRegex1 = re.compile(r"([^\d]),")
+commaRegex2 = re.compile(r",([^\d])")
+commaRegex3 = re.compile(r"(\d),$")
+contractionRegexes = {
+    "right": [(re.compile(r"([\W\d_])'([\W\d_])"), r"\1 ' \2"),
+              (re.compile(r"([\W_])'([^\W\d_])"), r"\1 ' \2"),
+              (re.compile(r"([^\W\d_])'([\W\d_])"), r"\1 ' \2"),
+              (re.compile(r"([^\W\d_])'([^\W\d_])"), r"\1 '\2"),
+              (re.compile(r"(\d)'(s)"), r"\1 '\2")],
+    "left": [(re.compile(r"([\W\d_])'([\W\d_])"), r"\1 ' \2"),
+             (re.compile(r"([\W\d_])'([^\W\d_])"), r"\1 ' \2"),
+             (re.compile(r"([^\W\d_])'([\W\d_])"), r"\1 ' \2"),
+             (re.compile(r"([^\W\d_])'([^\W\d_])"), r"\1' \2")],
+    "none": [(re.compile(r"'"), r" ' ")]}
+finalQuoteRegex = re.compile(r"\.\' ?$")
+tagLineRegex = re.compile(r"^<.+>$")
+
+
+class MosesTokeniser():
+    """In-process reimplementation of the Moses tokenisation script, run 
+    with the options -no-escape and -b (without aggressive hyphen splitting).
     
+    """
+    
+    def __init__(self, langcode="en"):
+        """Initialises the tokeniser for the language code (2-letters)."""
+        
+        self.langcode = langcode
+        self.prefixes = getNonBreakingPrefixes(langcode)
+        if langcode == "en":
+            self.contractions = contractionRegexes["right"]
+        elif langcode in ["fr", "it", "ga"]:
+            self.contractions = contractionRegexes["left"]
+        else:
+            self.contractions = contractionRegexes["none"]
+            
+            
+    def tokenise(self, line):
+        """Tokenises the line and returns the tokens separated by spaces."""
+        
+        # Like the script, lines with tags or whitespaces are left untouched
+        if not line.strip() or tagLineRegex.match(line):
+            return line
+        text = " " + line.strip("\n") + " "
+        text = re.sub(r"\s+", " ", text)
+        text = junkRegex.sub("", text)
+        
+        # Separates out all "other" special characters
+        text = specialCharRegex.sub(r" \1 ", text)
+        
+        # Multi-dots stay together
+        text = multiDotRegex.sub(r" DOTMULTI\1", text)
+        while "DOTMULTI." in text:
+            text = multiDotRegex2.sub(r"DOTDOTMULTI \1", text)
+            text = text.replace("DOTMULTI.", "DOTDOTMULTI")
+            
+        # Separates out "," except if within numbers
+        text = commaRegex1.sub(r"\1 , ", text)
+        text = commaRegex2.sub(r" , \1", text)
+        text = commaRegex3.sub(r"\1 ,", text)
+        
+        # Splits the contractions (language-specific)
+        for regex, replacement in self.contractions:
+            text = regex.sub(replacement, text)
+            
+        # Separates the final dots (except for non-breaking prefixes)
+        words = text.split(" ")
+        while words and not words[-1]:
+            words.pop()
+        for i, word in enumerate(words):
+            if len(word) > 1 and word.endswith("."):
+                pre = word[:-1]
+                prefix = self.prefixes.get(pre)
+                nextWord = words[i+1] if i < len(words)-1 else ""
+                if (("." in pre and any(c.isalpha() for c in pre)) or prefix == 1 
+                    or (nextWord and nextWord[0].islower())):
+                    pass
+                elif prefix == 2 and nextWord and nextWord[0] in "0123456789":
+                    pass
+                else:
+                    words[i] = pre + " ."
+        text = " ".join(words)
+        
+        # Cleans up extraneous spaces
+        text = " ".join([w for w in text.split(" ") if w])
+        text = finalQuoteRegex.sub(" . ' ", text, 1)
+        
+        # Restores the multi-dots
+        while "DOTDOTMULTI" in text:
+            text = text.replace("DOTDOTMULTI", "DOTMULTI.")
+        text = text.replace("DOTMULTI", ".")
+        return text
+
+
 wordRegex = re.compile("\w[\w\-']*$")
+ocrMappings = [("ii", "ll"), ("II", "ll"), ("l", "I"),
+               ("i", "l"), ("I", "l"), ("l", "i")]
 digitRegex = re.compile("\d")
 
 class SpellChecker():
    
-    def __init__(self, language=None):
+    def __init__(self, language=None, cacheSize=None):
        
        if isinstance(language,str):
            language = getLanguage(language)
        self.language = language
        self.dictionary = language.getDictionary() if language else None
        self.lm = language.getLanguageModel() if language else None
-       self.nbUnknowns = 0
-       self.nbCorrections = 0
-       self.nbTruecased = 0
+       cacheSize = scoringCacheSize if cacheSize is None else cacheSize
+       self.scoreCache = LRUCache(cacheSize)
+       self.decisionCache = LRUCache(cacheSize)
+       self.resetCounters()
        
+       
+    def resetCounters(self):
+        """Resets the counts of unknown, corrected and truecased words (used
+        when the spellchecker is reused across several subtitles).
+        
+        """
+        self.nbUnknowns = 0
+        self.nbCorrections = 0
+        self.nbTruecased = 0
+       
+    
+    def _getCacheKey(self, token, previous):
+        """Returns the cache key for the token and its previous token. Without
+        a language model, only the presence of a previous token matters.
+        
+        """
+        return (previous if self.lm else bool(previous)), token
+    
     
     def _score(self, token, previous=None):
+        key = self._getCacheKey(token, previous)
+        score = self.scoreCache.get(key)
+        if score is None:
+            score = self._computeScore(token, previous)
+            self.scoreCache.put(key, score)
+        return score
+    
+    
+    def _computeScore(self, token, previous=None):
         if self.lm:
             if previous:
                 scores = self.lm.full_scores(previous + " " + token, False, False)                        
@@ -312,7 +692,30 @@ class SpellChecker():
             token.encode("iso-8859-1")
         except:
             return token, 1.0
-                             
+        
+        key = self._getCacheKey(token, previous)
+        decision = self.decisionCache.get(key)
+        if decision is None:
+            decision = self._decide(token, previous)
+            self.decisionCache.put(key, decision)
+        best, prob, isword = decision
+        
+        if not isword:
+            self.nbUnknowns += 1
+        if best != token:
+            before = ((previous + " ") if previous else "") + token
+            after = ((previous + " ") if previous else "") + best
+            sys.stderr.write("Correction: %s -> %s (probability %f)\n" % (before, after, prob))
+            self.nbCorrections += 1
+        
+        return best, prob
+    
+    
+    def _decide(self, token, previous=None):
+        """Searches for the best correction of the token, and returns a triple
+        with the correction, its probability, and whether the token is a word.
+        
+        """
         score, isword = self._score(token, previous)
         if token.istitle():
             score += (5.0 if token[0]!= "I" else 2.0)
@@ -331,16 +734,7 @@ class SpellChecker():
         for alt in altprobs:
             altprobs[alt] = altprobs[alt] / total
         best = max(altprobs.keys(), key=lambda a : altprobs[a])      
-
-        if not isword:
-            self.nbUnknowns += 1
-        if best != token:
-            before = ((previous + " ") if previous else "") + token
-            after = ((previous + " ") if previous else "") + best
-            sys.stderr.write("Correction: %s -> %s (probability %f)\n" % (before, after, altprobs[best]))
-            self.nbCorrections += 1
-        
-        return best, altprobs[best]
+        return best, altprobs[best], isword
          
             
 
@@ -362,18 +756,18 @@ class SpellChecker():
             and not word.islower() and not word.isupper() and not word.istitle()):
             return corrections.union(self._getAlternatives(word.lower(), previous, False))
        
-        # OCR errors
-        mappings = [("ii", "ll"), ("II", "ll"), ("l", "I"),
-                    ("i", "l"), ("I", "l"), ("l", "i")]
-        
-        for m in mappings:
-            matches = re.finditer(r"(?=%s)" % (m[0]), word)
-            for match in matches:
-                pos = match.start()
+        # OCR errors (the corrected words necessarily have the same key as
+        # the word in the confusion index)
+        candidates = self.dictionary.getConfusionCandidates(word)
+        for m in ocrMappings if candidates else ():
+            pos = word.find(m[0])
+            while pos >= 0:
                 replace = word[:pos] + m[1] + word[pos + len(m[0]):]
-                if (self.dictionary.isWord(replace) and 
-                    (m != ("l", "I") or pos == 0)):
+                rlow = replace.lower()
+                if ((rlow in candidates or rlow.replace("'", "").replace("-", "") 
+                     in candidates) and (m != ("l", "I") or pos == 0)):
                     corrections.add(replace)
+                pos = word.find(m[0], pos + 1)
         
         # Wrong accents
         if self.dictionary.no_accents:
@@ -416,6 +810,7 @@ class Language:
         self.codes = [] 
         self.dictionary = None
         self.lm = None
+        self.tokeniser = None
         self.scripts = scripts
         self.encodings = []
         if "arabic" in self.scripts or "hebrew" in self.scripts:
@@ -435,27 +830,42 @@ class Language:
         
             
     def getDictionary(self):
-        """Constructs the dictionary for the language."""
+        """Returns the dictionary for the language. The dictionary is loaded
+        on first use, and shared with the other languages using the same file.
         
+        """
         if isinstance(self.dictionary, Dictionary):
             return self.dictionary
         elif self.dictionary:
-            accented = self.codes[0] in ["fr","de","es","it","pt"]
-            self.dictionary = Dictionary(self.dictionary, accented)
+            path, accented = self.dictionary, self.isAccented()
+            self.dictionary = getSharedResource(("dictionary", path, accented),
+                                                lambda : loadDictionary(path, accented))
             return self.dictionary
         return None
     
-        
     
     def getLanguageModel(self):
+        """Returns the language model for the language. The model is loaded on
+        first use, and shared with the other languages using the same file.
+        
+        """
         import kenlm
         if isinstance(self.lm, kenlm.LanguageModel):
             return self.lm
         elif self.lm:
-            self.lm = kenlm.LanguageModel(self.lm)
+            path = self.lm
+            self.lm = getSharedResource(("lm", path), lambda : kenlm.LanguageModel(path))
             return self.lm
         return None
     
+    
+    def isAccented(self):
+        """Returns true if the dictionary of the language should include the
+        unaccented forms of its words (to correct wrong or missing accents).
+        
+        """
+        return self.codes[0] in ["fr","de","es","it","pt"]
+    
 
     def __str__(self):
         """Returns the language name."""
@@ -507,12 +917,20 @@ class Language:
         return 0.0
     
 
+# Process-wide registry of the languages and of their loaded resources
+_languageRegistry = {}
+_sharedResources = {}
+resourceStats = []
+
 def getLanguage(langcode):
     """Returns the language object given the code. If no language can be found
-    with the provided code, raises a RuntimeError".
+    with the provided code, raises a RuntimeError". The language objects are 
+    created once per process and then reused.
     
     """
-    if langcode in languages.keys():
+    if langcode in _languageRegistry:
+        return _languageRegistry[langcode]
+    elif langcode in languages.keys():
         content = languages[langcode]
         if isinstance(content, dict):
             lang = Language(content["name"], content["scripts"])
@@ -522,12 +940,68 @@ def getLanguage(langcode):
                 lang.dictionary = content["dictionary"]
             if "lm" in content:
                 lang.lm = content["lm"]
-            return lang
+            if "tokeniser" in content:
+                lang.tokeniser = content["tokeniser"]
         else:
-            return getLanguage(content)
+            lang = getLanguage(content)
+        _languageRegistry[langcode] = lang
+        return lang
     else:
         raise RuntimeError("Cannot find language with code %s" % langcode)
 
+
+def getSharedResource(key, loader):
+    """Returns the resource (dictionary or language model) with the given key,
+    calling the loader function if the resource has not yet been loaded in
+    the process. The load time and memory of each resource are recorded in
+    resourceStats.
+    
+    """
+    if key not in _sharedResources:
+        memory, start = getMemoryUsage(), time.time()
+        _sharedResources[key] = loader()
+        resourceStats.append((key, time.time() - start, getMemoryUsage() - memory))
+    return _sharedResources[key]
+
+
+def getMemoryUsage():
+    """Returns the resident memory of the process, in megabytes (or its peak
+    resident memory if the current one cannot be read).
+    
+    """
+    try:
+        with open("/proc/self/statm") as fd:
+            pages = int(fd.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 1048576.0
+    except (IOError, OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def getResourceReport():
+    """Returns a report on the resources loaded in the process, with their 
+    load times and memory use.
+    
+    """
+    report = ""
+    for key, duration, memory in resourceStats:
+        report += ("Loaded %s %s in %.2f s (%+.1f MB)\n"
+                   %(key[0], key[1], duration, memory))
+    report += "Resident memory: %.1f MB\n"%getMemoryUsage()
+    return report
+
+
+def loadDictionary(dicFile, accented=False):
+    """Loads the dictionary from its compiled version if the latter is up to
+    date, and from the text file otherwise.
+    
+    """
+    if isCompiledUpToDate(dicFile, accented):
+        return Dictionary(getCompiledPath(dicFile))
+    sys.stderr.write("No up-to-date compiled version of " + dicFile
+                     + ", reading the text file\n")
+    return Dictionary(dicFile, accented)
+
    
 class Dictionary():
     """Representation of a dictionary containing a list of words for a given 
@@ -539,13 +1013,18 @@ class Dictionary():
     def __init__(self, dicFile, accented=False):
         """Creates a new dictionary from a given file.  Each line in the file 
         must contain a word followed by a space or tab and an integer 
-        representing the frequency of the word.
+        representing the frequency of the word. The file can also be a 
+        compact dictionary (see save), which is then memory-mapped.
         
         """
         sys.stderr.write("Building dictionary from " + dicFile + "\n")
         if not os.path.exists(dicFile):
             raise RuntimeError("Unigrams file " + dicFile + " cannot be found")
         self.dicFile = dicFile
+        if isCompactDictionary(dicFile):
+            self._loadCompact(dicFile)
+            return
+        
         self.words = collections.defaultdict(int)
         with io.open(dicFile, encoding="utf-8") as dico:
             for l in dico:
@@ -568,7 +1047,84 @@ class Dictionary():
                 if (stripped not in self.no_accents or 
                     self.words[w] > self.words[self.no_accents[stripped]]):
                     self.no_accents[stripped] = w
+        
+        # Index of the words that can be reached by correcting OCR errors 
+        self.confusions = None
+        self.getConfusions()
+      
       
+    def _loadCompact(self, dicFile):
+        """Memory-maps the compact dictionary file, so that its content is
+        shared by all processes using the same file.
+        
+        """
+        with open(dicFile, 'rb') as fd:
+            header, dataStart = readCompactHeader(fd)
+            buffer = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        self.words = StringTable(buffer, dataStart, header["tables"]["words"])
+        self.no_accents = StringTable(buffer, dataStart, header["tables"]["accents"], 
+                                      self.words)
+        self.confusions = None
+        if "confusions" in header["tables"]:
+            self.confusions = StringTable(buffer, dataStart, header["tables"]["confusions"],
+                                          self.words)
+        sys.stderr.write("Total number of words in dictionary: %i\n" % (len(self.words)))
+        
+        
+    def save(self, outFile, source=None):
+        """Writes the dictionary in a compact, read-only format that can be
+        memory-mapped: each table is a sorted list of utf-8 strings with their
+        offsets, followed by an array of integer values (the frequencies for 
+        the words, and the word indices for the unaccented forms). The OCR
+        confusion index is stored in the same way, with a list of postings 
+        (word indices) for each key. Information on the source file (see 
+        getSourceInfo) can be stored in the header.
+        
+        """
+        words = sorted(self.words.items(), key=lambda x : x[0].encode("utf-8"))
+        indices = {w:i for i, (w,_) in enumerate(words)}
+        accents = sorted([(s, indices[w]) for s, w in self.no_accents.items()], 
+                         key=lambda x : x[0].encode("utf-8"))
+        confusions = []
+        postings = array.array("I")
+        for key, confused in sorted(self.getConfusions().items(), 
+                                    key=lambda x : x[0].encode("utf-8")):
+            confusions.append((key, len(postings)))
+            postings.extend(sorted(indices[w] for w in confused))
+        
+        sections = []
+        tables = {}
+        position = 0
+        for name, items in [("words", words), ("accents", accents), 
+                            ("confusions", confusions)]:
+            table = {"size":len(items)}
+            keys = [k.encode("utf-8") for k, _ in items]
+            offsets = array.array("I", [0])
+            for k in keys:
+                offsets.append(offsets[-1] + len(k))
+            values = array.array("q", [v for _, v in items])
+            parts = [("keys", b"".join(keys)), ("offsets", offsets.tobytes()),
+                     ("values", values.tobytes())]
+            if name == "confusions":
+                parts.append(("postings", postings.tobytes()))
+            for part, content in parts:
+                table[part] = [position, len(content)]
+                padding = b"\0" * (-len(content) % 8)
+                sections.append(content + padding)
+                position += len(content) + len(padding)
+            tables[name] = table
+            
+        # The header is padded so that the sections are aligned on 8 bytes
+        header = json.dumps({"version":compactVersion, "tables":tables, 
+                             "source":source}).encode("utf-8")
+        header += b" " * (-(len(compactMagic) + 4 + len(header)) % 8)
+        
+        tmpFile = outFile + ".tmp%i"%os.getpid()
+        with open(tmpFile, 'wb') as fd:
+            fd.write(compactMagic + struct.pack("<I", len(header)) + header)
+            for section in sections:
+                fd.write(section)
+        os.replace(tmpFile, outFile)
                
  
     def isWord(self, word):
@@ -580,6 +1136,26 @@ class Dictionary():
         return wlow in self.words or re.sub(r"['-]", "", wlow) in self.words
     
     
+    def getConfusions(self):
+        """Returns the OCR confusion index of the dictionary, mapping each key
+        (see confusionKey) to the words with this key.
+        
+        """
+        if self.confusions is None:
+            self.confusions = collections.defaultdict(list)
+            for w in self.words:
+                self.confusions[confusionKey(w)].append(w)
+        return self.confusions
+    
+    
+    def getConfusionCandidates(self, word):
+        """Returns the dictionary words that have the same key as the word in
+        the OCR confusion index (an empty tuple if there are none).
+        
+        """
+        return self.getConfusions().get(confusionKey(word), ())
+        
+        
     def correctAccents(self, word):
         if self.no_accents:
             stripped = strip(word)
@@ -599,11 +1175,195 @@ class Dictionary():
         if wlow in self.words:
             return self.words[wlow]
         elif re.sub(r"['-]", "", wlow):
-            return self.words[re.sub(r"['-]", "", wlow)]
+            return self.words.get(re.sub(r"['-]", "", wlow), 0)
         else:
             return 0
 
 
+# Magic string at the start of compact dictionary files, and format version
+compactMagic = b"OSDICT\0\1"
+compactVersion = 2
+
+
+def confusionKey(word):
+    """Returns the key of the word in the OCR confusion index: the word is 
+    lowercased and stripped of apostrophes and hyphens (as in isWord), and 
+    the letters i and l, which are often confused, are merged.
+    
+    """
+    return word.lower().replace("'", "").replace("-", "").replace("l", "i")
+
+def isCompactDictionary(dicFile):
+    """Returns true if the file is a compact dictionary (see Dictionary.save)."""
+    
+    with open(dicFile, 'rb') as fd:
+        return fd.read(len(compactMagic)) == compactMagic
+    
+    
+def readCompactHeader(fd):
+    """Reads the header of the compact dictionary in the (binary) file object,
+    and returns it together with the position of the data in the file.
+    
+    """
+    fd.seek(len(compactMagic))
+    headerLength = struct.unpack("<I", fd.read(4))[0]
+    header = json.loads(fd.read(headerLength).decode("utf-8"))
+    return header, len(compactMagic) + 4 + headerLength
+
+
+def getCompiledPath(dicFile):
+    """Returns the path of the compiled version of the dictionary file."""
+    return dicFile + ".bin"
+
+
+def getSourceInfo(dicFile, accented, withHash=True):
+    """Returns the modification time, size and SHA-1 hash of the text 
+    dictionary file, along with the accented flag used to compile it.
+    
+    """
+    stat = os.stat(dicFile)
+    info = {"mtime":stat.st_mtime, "size":stat.st_size, "accented":accented}
+    if withHash:
+        sha1 = hashlib.sha1()
+        with open(dicFile, 'rb') as fd:
+            for chunk in iter(lambda : fd.read(1 << 20), b""):
+                sha1.update(chunk)
+        info["sha1"] = sha1.hexdigest()
+    return info
+
+
+def compileDictionary(dicFile, accented=False):
+    """Compiles the text dictionary file into a compact dictionary placed
+    next to it, which records the source file it was compiled from.
+    
+    """
+    source = getSourceInfo(dicFile, accented)
+    Dictionary(dicFile, accented).save(getCompiledPath(dicFile), source)
+    sys.stderr.write("Compiled dictionary " + getCompiledPath(dicFile) + "\n")
+    
+    
+def isCompiledUpToDate(dicFile, accented=False):
+    """Returns true if the compiled version of the dictionary file exists and
+    matches the text file. The hash of the text file is only computed if its
+    modification time has changed.
+    
+    """
+    compiled = getCompiledPath(dicFile)
+    if not os.path.exists(compiled) or not isCompactDictionary(compiled):
+        return False
+    with open(compiled, 'rb') as fd:
+        header = readCompactHeader(fd)[0]
+    source = header.get("source")
+    if header.get("version") != compactVersion:
+        return False
+    current = getSourceInfo(dicFile, accented, False)
+    if (not source or source["size"] != current["size"] 
+        or source["accented"] != accented):
+        return False
+    elif source["mtime"] == current["mtime"]:
+        return True
+    return source["sha1"] == getSourceInfo(dicFile, accented)["sha1"]
+    
+
+class StringTable():
+    """Read-only mapping from strings to integers, stored as a sorted table 
+    of utf-8 strings (with their offsets) and an array of values, typically
+    in a memory-mapped file. The lookups are done by binary search.  If a 
+    target table is provided, the values are indices of strings in the 
+    target table, and the mapping returns these strings. If the table has
+    postings, the values are the start positions of lists of such indices,
+    and the mapping returns tuples of strings.
+    
+    """
+    
+    def __init__(self, buffer, dataStart, description, target=None):
+        """Initialises the table from the buffer and the description (size
+        and positions of the keys, offsets and values, relative to the start
+        of the data) in the file header.
+        
+        """
+        self.buffer = buffer
+        self.size = description["size"]
+        self.keysStart = dataStart + description["keys"][0]
+        view = memoryview(buffer)
+        start, length = description["offsets"]
+        self.offsets = view[dataStart+start:dataStart+start+length].cast("I")
+        start, length = description["values"]
+        self.values = view[dataStart+start:dataStart+start+length].cast("q")
+        self.postings = None
+        if "postings" in description:
+            start, length = description["postings"]
+            self.postings = view[dataStart+start:dataStart+start+length].cast("I")
+        self.target = target
+        
+        
+    def _find(self, key):
+        """Returns the position of the key in the table, or -1 if absent."""
+        
+        key = key.encode("utf-8", "surrogatepass")
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            current = self.keyAt(middle, False)
+            if current < key:
+                low = middle + 1
+            elif current > key:
+                high = middle
+            else:
+                return middle
+        return -1
+    
+    
+    def keyAt(self, position, decode=True):
+        """Returns the key at the given position in the table."""
+        
+        key = self.buffer[self.keysStart + self.offsets[position]:
+                          self.keysStart + self.offsets[position+1]]
+        return key.decode("utf-8") if decode else key
+        
+        
+    def valueAt(self, position):
+        """Returns the value at the given position in the table."""
+        
+        value = self.values[position]
+        if self.postings is not None:
+            end = self.values[position+1] if position+1 < self.size else len(self.postings)
+            return tuple(self.target.keyAt(i) for i in self.postings[value:end])
+        return self.target.keyAt(value) if self.target else value
+    
+    
+    def get(self, key, default=None):
+        position = self._find(key)
+        return self.valueAt(position) if position >= 0 else default
+    
+    
+    def __getitem__(self, key):
+        position = self._find(key)
+        if position < 0:
+            raise KeyError(key)
+        return self.valueAt(position)
+    
+    
+    def __contains__(self, key):
+        return self._find(key) >= 0
+    
+    
+    def __len__(self):
+        return self.size
+    
+    
+    def __iter__(self):
+        return (self.keyAt(i) for i in range(0, self.size))
+    
+    
+    def keys(self):
+        return iter(self)
+    
+    
+    def items(self):
+        return ((self.keyAt(i), self.valueAt(i)) for i in range(0, self.size))
+
+
 # Equivalence table between specific (German) characters and their ascii encoding
 eqTable = {ord('ß'):'ss', ord('ç'):'c', ord('ä'):'ae', ord('ö'):'oe', ord('ü'):'ue', 
            ord('Ö'):'Oe', ord("Ü"):"Ue", ord("Ä"):'Ae'}
@@ -619,8 +1379,22 @@ def strip(word):
     return stripped
 
 
-   
-        
-
-
-  
+if __name__ == '__main__':
+    
+    import argparse
+    
+    cmdOptions = argparse.ArgumentParser(prog="utils")
+    cmdOptions.add_argument("langcodes", nargs="*", 
+                            help="""codes of the languages whose dictionaries should be
+                            compiled (if omitted, compiles all dictionaries)""")
+    args = cmdOptions.parse_args()
+    
+    langcodes = args.langcodes or [l for l in languages if isinstance(languages[l], dict)
+                                   and "dictionary" in languages[l]]
+    for langcode in langcodes:
+        lang = getLanguage(langcode)
+        if isinstance(lang.dictionary, str):
+            if isCompiledUpToDate(lang.dictionary, lang.isAccented()):
+                sys.stderr.write("Compiled dictionary for %s is up to date\n"%lang)
+            else:
+                compileDictionary(lang.dictionary, lang.isAccented())
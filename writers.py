@@ -0,0 +1,402 @@
+# -*- coding: utf-8 -*-
+
+description = """
+Output writers for the converted subtitles: XML (the default format),
+Moses-style tokenised text, JSON Lines, and a compact binary columnar format
+that can be memory-mapped.
+
+"""
+
+import json, struct, array, mmap
+
+
+# Escaping of XML text content and attribute values
+def escapeText(text):
+    """Escapes the special characters in XML text content."""
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    return text
+
+def escapeAttribute(text):
+    """Escapes the special characters (including quotes and whitespaces other
+    than the space) in XML attribute values.
+
+    """
+    text = escapeText(text)
+    if "\"" in text:
+        text = text.replace("\"", "&quot;")
+    if "\r" in text:
+        text = text.replace("\r", "&#13;")
+    if "\n" in text:
+        text = text.replace("\n", "&#10;")
+    if "\t" in text:
+        text = text.replace("\t", "&#09;")
+    return text
+
+def formatAttributes(attrs):
+    """Returns the XML attributes (in the order of the dictionary)."""
+    return "".join([' %s="%s"'%(key, escapeAttribute(value))
+                    for key, value in attrs.items()])
+
+def formatElement(tag, attrs=None, text=None):
+    """Returns the XML element with the given tag, attributes and text, in the
+    same form as ElementTree (empty elements are self-closed).
+
+    """
+    element = "<" + tag + (formatAttributes(attrs) if attrs else "")
+    if text:
+        return element + ">" + escapeText(text) + "</" + tag + ">"
+    return element + " />"
+
+
+def formatTime(millis):
+    """Formats the number of milliseconds as a HH:MM:SS,mmm time string."""
+    sign = "-" if millis < 0 else ""
+    secs, millis = divmod(abs(millis), 1000)
+    mins, secs = divmod(secs, 60)
+    hours, mins = divmod(mins, 60)
+    return sign + "%02d:%02d:%02d,%03d"%(hours, mins, secs, millis)
+
+
+def getAttributes(entity, withEmphasis=True):
+    """Returns the attributes of the token entity (emphasis, initial form and
+    alternative form), if they are set.
+
+    """
+    attrs = {}
+    if entity[2] and withEmphasis:
+        attrs["emphasis"] = "true"
+    if entity[3]:
+        attrs["initial"] = entity[3]
+    if entity[4]:
+        attrs["alternative"] = entity[4]
+    return attrs
+
+
+class XMLWriter:
+    """Writer for the XML format, with one <s> element per sentence (with <w>
+    and <time> elements for the tokenised output, and the untokenised text
+    for the raw output) and the meta-data at the end of the document.
+
+    """
+    extension = "xml"
+
+    def __init__(self, output, raw=False):
+        """Creates a new writer for the output file object.
+
+        Args:
+            output(file object): binary file object to write to
+            raw(bool): whether the writer is for the untokenised output
+        """
+        self.output = output
+        self.raw = raw
+        self.buffer = bytearray()
+
+
+    def startDocument(self, id):
+        self.output.write(b'<?xml version="1.0" encoding="utf-8"?>\n')
+        self.output.write(b'<document id="' + id.encode("utf-8") + b'">\n')
+
+
+    def writeSentence(self, sid, sentence):
+        """Writes the sentence with the given identifier."""
+
+        if self.raw:
+            self._writeRaw(sid, sentence)
+        else:
+            self._writeTokens(sid, sentence)
+
+
+    def _writeTokens(self, sid, sentence):
+        emphasised = sentence.isEmphasised()
+        if emphasised:
+            parts = ['  <s id="%i" emphasis="true">'%sid]
+        else:
+            parts = ['  <s id="%i">'%sid]
+        tokid = 0
+        for entity in sentence.getEntities():
+
+            if entity[0]=="w":
+                tokid += 1
+                wattrs = {"id":"%i.%i"%(sid,tokid)}
+                wattrs.update(getAttributes(entity, not emphasised))
+                parts.append("\n    ")
+                parts.append(formatElement("w", wattrs, entity[1]))
+
+            # Write a <time> entity
+            elif entity[0]=="time":
+                parts.append("\n    ")
+                parts.append(self._formatStamp(entity))
+
+        parts.append("\n  </s>\n")
+        self._writeParts(parts)
+
+
+    def _writeRaw(self, sid, sentence):
+        parts = ['  <s id="%i">'%sid]
+
+        # Add timing info at the beginning of the sentence
+        entities = sentence.getEntities()
+        if entities and entities[0][0] == "time":
+            parts.append("\n    ")
+            parts.append(self._formatStamp(entities[0]))
+
+        parts.append("\n")
+        parts.append(escapeText(sentence.raw))
+
+        # Add timing info at the end of the sentence
+        if entities and entities[-1][0] == "time":
+            parts.append("\n    ")
+            parts.append(self._formatStamp(entities[-1]))
+
+        parts.append("\n  </s>\n")
+        self._writeParts(parts)
+
+
+    def _formatStamp(self, entity):
+        """Returns the <time> element for the time stamp entity."""
+        return formatElement("time", {"id":entity[1], "value":entity[3]})
+
+
+    def _writeParts(self, parts):
+        """Writes the XML fragments to the output, encoded in one go in the
+        reusable byte buffer of the writer.
+
+        """
+        buffer = self.buffer
+        buffer += "".join(parts).encode("utf-8", "xmlcharrefreplace")
+        self.output.write(buffer)
+        del buffer[:]
+
+
+    def endDocument(self, meta):
+        """Writes the meta-data and closes the document."""
+
+        parts = ["  <meta>"]
+        for part in meta:
+            parts.append("\n    <%s>"%part)
+            if isinstance(meta[part],dict):
+                for key in meta[part]:
+                    parts.append("\n      ")
+                    parts.append(formatElement(key, None, meta[part][key]))
+            parts.append("\n    </%s>"%part)
+        parts.append("\n  </meta>\n</document>\n")
+        self._writeParts(parts)
+
+
+
+class TextWriter:
+    """Writer for Moses-style text, with one sentence per line (the tokens
+    being separated by spaces). The meta-data is not written.
+
+    """
+    extension = "txt"
+
+    def __init__(self, output, raw=False):
+        self.output = output
+        self.raw = raw
+
+    def startDocument(self, id):
+        pass
+
+    def writeSentence(self, sid, sentence):
+        if self.raw:
+            line = " ".join(sentence.raw.split())
+        else:
+            line = " ".join([entity[1] for entity in sentence.getEntities()
+                             if entity[0]=="w"])
+        self.output.write((line + "\n").encode("utf-8", "replace"))
+
+    def endDocument(self, meta):
+        pass
+
+
+
+class JSONWriter:
+    """Writer for JSON Lines, with one object per sentence.  The first line
+    contains the document identifier, and the last one the meta-data.
+
+    A tokenised sentence is written as {"id", "tokens", "timings"}, where
+    each timing has an identifier, a value (also in milliseconds) and the
+    position of the next token. The emphasis is marked on the sentence if
+    all tokens are emphasised, and the token attributes (if any) are listed
+    in "attributes". A raw sentence is written as {"id", "text", "timings"}.
+
+    """
+    extension = "jsonl"
+
+    def __init__(self, output, raw=False):
+        self.output = output
+        self.raw = raw
+
+    def startDocument(self, id):
+        self._writeLine({"document":id})
+
+    def writeSentence(self, sid, sentence):
+        entities = sentence.getEntities()
+        line = {"id":sid}
+        if self.raw:
+            line["text"] = sentence.raw
+            entities = [e for e in (entities[:1] + entities[1:][-1:]) if e[0]=="time"]
+        else:
+            line["tokens"] = [e[1] for e in entities if e[0]=="w"]
+        timings = []
+        position = 0
+        for entity in entities:
+            if entity[0]=="w":
+                position += 1
+            else:
+                timing = {"id":entity[1], "value":entity[3], "ms":entity[2]}
+                if not self.raw:
+                    timing["token"] = position
+                timings.append(timing)
+        line["timings"] = timings
+
+        if not self.raw:
+            emphasised = sentence.isEmphasised()
+            if emphasised:
+                line["emphasis"] = True
+            attributes = [getAttributes(e, not emphasised) 
+                          for e in entities if e[0]=="w"]
+            if [a for a in attributes if a]:
+                line["attributes"] = attributes
+        self._writeLine(line)
+
+    def endDocument(self, meta):
+        self._writeLine({"meta":meta})
+
+    def _writeLine(self, content):
+        line = json.dumps(content, ensure_ascii=False) + "\n"
+        self.output.write(line.encode("utf-8", "replace"))
+
+
+
+# Magic string at the start of binary columnar files
+columnarMagic = b"OSCOL\0\0\1"
+
+class ColumnarWriter:
+    """Writer for the binary columnar format. The document is written when
+    it ends, as a header followed by the columns (aligned on 8 bytes):
+    - vocabulary: the utf-8 strings of the distinct tokens, concatenated
+    - vocabulary_offsets: uint32 offsets of the strings (plus the end offset)
+    - tokens: uint32 token identifiers (indices in the vocabulary)
+    - sentence_offsets: uint32 positions of the first token of each sentence
+      (plus the total number of tokens)
+    - sentence_ids: uint32 identifiers of the sentences
+    - start, end: int64 start and end times of the sentences in milliseconds
+      (-1 if unknown)
+    The header contains the magic string, the length of the JSON description
+    (uint32), and the JSON description itself with the positions of the
+    columns (relative to the end of the header), the document identifier and
+    the meta-data. For the raw output, each sentence has a single "token"
+    with the untokenised text.
+
+    """
+    extension = "bin"
+
+    def __init__(self, output, raw=False):
+        self.output = output
+        self.raw = raw
+
+    def startDocument(self, id):
+        self.id = id
+        self.vocabulary = {}
+        self.columns = {"tokens":array.array("I"), "sentence_offsets":array.array("I", [0]),
+                        "sentence_ids":array.array("I"), "start":array.array("q"),
+                        "end":array.array("q")}
+
+    def writeSentence(self, sid, sentence):
+        entities = sentence.getEntities()
+        tokens = [sentence.raw] if self.raw else [e[1] for e in entities if e[0]=="w"]
+        vocabulary = self.vocabulary
+        for token in tokens:
+            if token not in vocabulary:
+                vocabulary[token] = len(vocabulary)
+        columns = self.columns
+        columns["tokens"].extend([vocabulary[token] for token in tokens])
+        columns["sentence_offsets"].append(len(columns["tokens"]))
+        columns["sentence_ids"].append(sid)
+        # The start is given by the first start stamp, and the end by the last
+        # end stamp (a sentence may start or end in the middle of a block)
+        starts = [e[2] for e in entities if e[0]=="time" and e[1].endswith("S")]
+        ends = [e[2] for e in entities if e[0]=="time" and e[1].endswith("E")]
+        columns["start"].append(starts[0] if starts else -1)
+        columns["end"].append(ends[-1] if ends else -1)
+
+    def endDocument(self, meta):
+        words = [w.encode("utf-8", "replace") for w in self.vocabulary]
+        offsets = array.array("I", [0])
+        for w in words:
+            offsets.append(offsets[-1] + len(w))
+        sections = [("vocabulary", b"".join(words)),
+                    ("vocabulary_offsets", offsets.tobytes())]
+        sections += [(name, column.tobytes()) for name, column in self.columns.items()]
+
+        positions = {}
+        position = 0
+        for name, content in sections:
+            positions[name] = [position, len(content)]
+            position += len(content) + (-len(content) % 8)
+        header = json.dumps({"version":1, "id":self.id, "raw":self.raw,
+                             "sentences":len(self.columns["sentence_ids"]),
+                             "columns":positions, "meta":meta}).encode("utf-8")
+        header += b" " * (-(len(columnarMagic) + 4 + len(header)) % 8)
+
+        self.output.write(columnarMagic + struct.pack("<I", len(header)) + header)
+        for _, content in sections:
+            self.output.write(content + b"\0" * (-len(content) % 8))
+
+
+
+class ColumnarReader:
+    """Reader for documents in the binary columnar format (see ColumnarWriter),
+    giving access to the columns as memory views.
+
+    """
+
+    def __init__(self, buffer):
+        """Initialises the reader from a buffer (bytes or memory-mapped file)."""
+
+        if bytes(buffer[:len(columnarMagic)]) != columnarMagic:
+            raise RuntimeError("Not a columnar subtitle file")
+        headerLength = struct.unpack_from("<I", buffer, len(columnarMagic))[0]
+        headerStart = len(columnarMagic) + 4
+        self.header = json.loads(bytes(buffer[headerStart:headerStart+headerLength])
+                                 .decode("utf-8"))
+        dataStart = headerStart + headerLength
+        self.buffer = buffer
+        view = memoryview(buffer)
+        self.columns = {}
+        for name, (start, length) in self.header["columns"].items():
+            column = view[dataStart+start:dataStart+start+length]
+            self.columns[name] = column if name == "vocabulary" else column.cast(
+                "q" if name in ["start", "end"] else "I")
+
+    @classmethod
+    def fromFile(cls, path):
+        """Memory-maps the file and returns a reader for it."""
+        with open(path, 'rb') as fd:
+            return cls(mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def getWord(self, wordid):
+        offsets = self.columns["vocabulary_offsets"]
+        return bytes(self.columns["vocabulary"][offsets[wordid]:offsets[wordid+1]]
+                     ).decode("utf-8")
+
+    def getTokens(self, position):
+        """Returns the tokens of the sentence at the given position."""
+        offsets = self.columns["sentence_offsets"]
+        tokens = self.columns["tokens"][offsets[position]:offsets[position+1]]
+        return [self.getWord(t) for t in tokens]
+
+    def __len__(self):
+        return self.header["sentences"]
+
+
+# Output writers indexed by format name
+writers = {"xml":XMLWriter, "text":TextWriter, "jsonl":JSONWriter,
+           "binary":ColumnarWriter}